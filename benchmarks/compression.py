@@ -0,0 +1,93 @@
+"""
+Copyright 2016 by Bubble Zap, LLC
+See the LICENSE file distributed with this work for additional
+information regarding copyright ownership. The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Response compression cost against bytes saved.
+#
+# Builds catalog-shaped JSON bodies of several sizes and reports, for gzip and
+# (when installed) brotli, the compressed size and the CPU time per response.
+# The last column is the time compressResponse takes for a cached body.
+#
+# Usage: python benchmarks/compression.py [iterations]
+
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from django.conf import settings
+
+def makeCatalog(count):
+    items = []
+    for i in range(count):
+        items.append({
+            'ItemId': 'item_%05d' % i,
+            'ItemClass': ['Weapon', 'Armor', 'Potion', 'Bundle'][i % 4],
+            'CatalogVersion': 'Main',
+            'DisplayName': 'Item number %d' % i,
+            'Description': 'A fine item for the adventurer who has everything but item %d.' % i,
+            'VirtualCurrencyPrices': {'GC': (i * 37) % 1000 + 10, 'RM': 99},
+            'Consumable': {'UsageCount': i % 5} if i % 4 == 2 else None,
+            'Bundle': {'BundledItems': ['item_%05d' % ((i + 1) % count)], 'BundledVirtualCurrencies': {'GC': 100}} if i % 4 == 3 else None,
+            'CustomData': json.dumps({'Power': i % 97, 'Rarity': i % 5}),
+            'IsStackable': i % 4 == 2,
+            'IsTradable': False,
+        })
+    return json.dumps({'code': 200, 'status': 'OK', 'data': {'Catalog': items}}).encode('utf-8')
+
+class Request(object):
+    def __init__(self, acceptEncoding):
+        self.META = {'HTTP_ACCEPT_ENCODING': acceptEncoding}
+
+def timeIt(iterations, run):
+    start = time.time()
+    for i in range(iterations):
+        result = run()
+    return (time.time() - start) * 1000.0 / iterations, result
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    settings.configure(RESPONSE_COMPRESS_THRESHOLD=1024, RESPONSE_BROTLI_QUALITY=5)
+
+    from django.http import HttpResponse
+    from openplaykit import compression
+
+    encodings = [ compression.GZIP ]
+    if compression.brotli is not None:
+        encodings.append(compression.BROTLI)
+    else:
+        print('brotli not installed, gzip only')
+
+    print('%-8s %-5s %10s %10s %7s %10s %10s' % ('items', 'codec', 'bytes', 'sent', 'saved', 'ms/resp', 'cached ms'))
+    for count in (50, 500, 2000):
+        body = makeCatalog(count)
+        for encoding in encodings:
+            elapsed, compressed = timeIt(iterations, lambda: compression.compress(encoding, body))
+
+            request = Request(encoding)
+            compression.compressResponse(request, HttpResponse(body), 'bench')
+            cached, response = timeIt(iterations, lambda: compression.compressResponse(request, HttpResponse(body), 'bench'))
+            assert response['Content-Encoding'] == encoding
+            compression.bodyCache.clear()
+
+            saved = 100.0 * (len(body) - len(compressed)) / len(body)
+            print('%-8d %-5s %10d %10d %6.1f%% %10.2f %10.3f' % (count, encoding, len(body), len(compressed), saved, elapsed, cached))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+"""
+Copyright 2016 by Bubble Zap, LLC
+See the LICENSE file distributed with this work for additional
+information regarding copyright ownership. The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Client API endpoint benchmark on a seeded synthetic world.
+#
+# Builds a SQLite database with a catalog of --items items whose bundles nest
+# --depth levels deep, and --accounts players owning --inventory items,
+# --keys UserData keys and a Score and Kills statistic each, ranked on the
+# leaderboards. Every view in openplaykit/urls.py is then driven
+# through the Django test client. Latency percentiles, query counts and error
+# codes per endpoint are printed and written as JSON to --output, so runs on
+# different commits can be compared.
+#
+# Runs on SQLite without the App Engine stack, pycryptodome is needed for the
+# Google Play receipt endpoints.
+#
+# Usage: python benchmarks/endpoints.py [--items 200] [--depth 2] [--accounts 50]
+#            [--inventory 20] [--keys 10] [--iterations 50] [--output endpoints.json]
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import datetime
+import tempfile
+import subprocess
+
+from base64 import b64encode
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import django
+from django.conf import settings
+
+PASSWORD = 'benchmark'
+
+# Statistics every player has, each ranked on its own leaderboard
+STATISTICS = ['Score', 'Kills']
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description='Benchmark the Client API endpoints')
+    parser.add_argument('--items', type=int, default=200, help='catalog items')
+    parser.add_argument('--depth', type=int, default=2, help='bundle nesting depth')
+    parser.add_argument('--accounts', type=int, default=50, help='player accounts')
+    parser.add_argument('--inventory', type=int, default=20, help='inventory items per account')
+    parser.add_argument('--keys', type=int, default=10, help='UserData keys per account')
+    parser.add_argument('--value-size', type=int, default=2048, help='bytes per UserData value')
+    parser.add_argument('--iterations', type=int, default=50, help='requests per endpoint')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='endpoints.json', help='JSON results file')
+    return parser.parse_args()
+
+def makeSigningKey():
+    try:
+        from Crypto.PublicKey import RSA
+    except ImportError:
+        return None, ''
+    key = RSA.generate(2048)
+    return key, b64encode(key.publickey().exportKey('DER')).decode('ascii')
+
+def configure(databasePath, publicKey):
+    settings.configure(
+        DEBUG=False,
+        SECRET_KEY='benchmark',
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': databasePath}},
+        INSTALLED_APPS=('django.contrib.auth', 'django.contrib.contenttypes', 'django.contrib.sessions',
+            'django.contrib.messages', 'django.contrib.admin', 'openplaykit'),
+        MIDDLEWARE_CLASSES=('django.contrib.sessions.middleware.SessionMiddleware',
+            'django.contrib.auth.middleware.AuthenticationMiddleware',
+            'django.contrib.messages.middleware.MessageMiddleware'),
+        ROOT_URLCONF='openplaykit.urls',
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        # Hashing cost is not what is being measured
+        PASSWORD_HASHERS=('django.contrib.auth.hashers.MD5PasswordHasher',),
+        GOOGLE_PUBLIC_KEY=publicKey,
+        RECEIPT_VERIFY_WORKERS=0,
+        # SQLite and worker threads don't mix well
+        BATCH_WORKERS=0,
+    )
+    if hasattr(django, 'setup'):
+        django.setup()
+
+    from django.core.management import call_command
+    from django.core.management.base import CommandError
+    try:
+        call_command('syncdb', interactive=False, verbosity=0)
+    except CommandError:
+        call_command('migrate', run_syncdb=True, interactive=False, verbosity=0)
+
+def signReceipt(key, receipt):
+    from Crypto.Hash import SHA
+    from Crypto.Signature import PKCS1_v1_5
+    receiptJson = json.dumps(receipt)
+    return {'ReceiptJson': receiptJson, 'Signature': b64encode(PKCS1_v1_5.new(key).sign(SHA.new(receiptJson.encode('utf-8')))).decode('ascii')}
+
+class World(object):
+
+    def __init__(self, options, signingKey):
+        self.options = options
+        self.signingKey = signingKey
+        self.counter = 0
+        self.accounts = []
+
+    def nextId(self):
+        self.counter = self.counter + 1
+        return self.counter
+
+    def seed(self):
+        from django.contrib.auth.models import User
+        from openplaykit.models import (CurrencyType, Catalog, CatalogItem, ItemPrice, ItemAttribute, BundleItem,
+            BundleCurrency, TitleData, NewsItem, UserItems, UserCurrency, UserData, UserStatistic)
+
+        options = self.options
+        self.gold = CurrencyType.objects.create(CurrencyCode='GC', InitialDeposit=0, Description='Gold')
+        self.realMoney = CurrencyType.objects.create(CurrencyCode='RM', InitialDeposit=0, Description='Real Money')
+
+        # Bulk inserts skip the catalog signals, the snapshot is compiled on first request
+        catalog = Catalog.objects.create(Name='Main', IsDefault=True)
+        CatalogItem.objects.bulk_create([ CatalogItem(Catalog=catalog, ItemId='item_%05d' % i, ItemClass=['Weapon', 'Armor', 'Potion'][i % 3],
+            DisplayName='Item %d' % i, Description='Synthetic item %d' % i, UsageCount=5 if i % 3 == 2 else 0, IsStackable=i % 3 == 2)
+            for i in range(options.items) ])
+        self.items = list(CatalogItem.objects.filter(Catalog=catalog).order_by('pk'))
+        self.prices = dict((item.pk, 10 + i % 90) for i, item in enumerate(self.items))
+
+        ItemPrice.objects.bulk_create([ ItemPrice(Item=item, Currency=self.gold, Price=self.prices[item.pk]) for item in self.items ] +
+            [ ItemPrice(Item=item, Currency=self.realMoney, Price=99) for item in self.items ])
+        ItemAttribute.objects.bulk_create([ ItemAttribute(Item=item, Key='Rarity', Value=str(i % 5)) for i, item in enumerate(self.items) ])
+
+        # Chains of depth bundles: every item below the last level bundles the next one
+        bundles = []
+        currencies = []
+        for i, item in enumerate(self.items[:-1]):
+            if i % (options.depth + 1) < options.depth:
+                bundles.append(BundleItem(Item=item, BundledItem=self.items[i + 1]))
+                currencies.append(BundleCurrency(Item=item, Currency=self.gold, Amount=5))
+        BundleItem.objects.bulk_create(bundles)
+        BundleCurrency.objects.bulk_create(currencies)
+
+        TitleData.objects.bulk_create([ TitleData(Key='key%d' % i, Data=json.dumps({'Value': i})) for i in range(20) ])
+        NewsItem.objects.bulk_create([ NewsItem(Title='News %d' % i, Body='Body of news %d' % i) for i in range(20) ])
+
+        value = 'x' * options.value_size
+        for i in range(options.accounts):
+            account = self.createAccount()
+            owned = random.sample(self.items, min(options.inventory, len(self.items)))
+            UserItems.objects.bulk_create([ UserItems(Item=item, Account=account['Account'], RemainingUses=1000000) for item in owned ])
+            UserCurrency.objects.create(Account=account['Account'], Currency=self.gold, Amount=10 ** 9)
+            UserData.bulkUpsert(account['Account'], dict(('key%d' % k, value) for k in range(options.keys)))
+            UserStatistic.objects.bulk_create([ UserStatistic(Account=account['Account'], Name=name, Value=random.randint(0, 10 ** 6)) for name in STATISTICS ])
+            account['ItemId'] = owned[0].ItemId if owned else None
+            self.accounts.append(account)
+
+        User.objects.create_superuser('staff', 'staff@example.com', PASSWORD)
+
+    # Player with a username, an Android and an iOS device and a session ticket
+    def createAccount(self):
+        from openplaykit.models import UserAccount, ManagedUserAccount, AndroidDevice, IOSDevice
+
+        n = self.nextId()
+        account = UserAccount.objects.create(Origination='Android', DisplayName='Player %d' % n)
+        managed = ManagedUserAccount(Account=account, Username='player%d' % n, Email='player%d@example.com' % n)
+        managed.setPassword(PASSWORD)
+        managed.save()
+        AndroidDevice.objects.create(AndroidDeviceId='android%d' % n, OS='5.0', DeviceName='Benchmark', Account=account)
+        IOSDevice.objects.create(IOSDeviceId='ios%d' % n, OS='9.0', DeviceModel='Benchmark', Account=account)
+        return {'Account': account, 'Ticket': account.createSession(), 'Username': managed.Username, 'N': n}
+
+    def anyAccount(self):
+        return random.choice(self.accounts)
+
+    def anyItem(self):
+        return random.choice(self.items)
+
+    def googleReceipt(self):
+        item = self.anyItem()
+        return signReceipt(self.signingKey, {'orderId': 'GPA.%d.%f' % (self.nextId(), time.time()), 'packageName': 'com.example.game',
+            'productId': item.ItemId, 'purchaseTime': int(time.time() * 1000), 'purchaseState': 0})
+
+# Endpoint drivers, each returns (account or None, request body) built outside the timing
+def drivers(world):
+    keys = [ 'key%d' % k for k in range(world.options.keys) ]
+
+    def account(body):
+        return lambda: (world.anyAccount(), body() if callable(body) else body)
+
+    def fresh(body):
+        def make():
+            player = world.createAccount()
+            return player, body(player)
+        return make
+
+    def purchase():
+        item = world.anyItem()
+        return {'ItemId': item.ItemId, 'VirtualCurrency': 'GC', 'Price': world.prices[item.pk], 'CatalogVersion': 'Main'}
+
+    def launchBatch():
+        return {'Requests': [ {'Name': 'GetTitleData', 'Body': {}}, {'Name': 'GetTitleNews', 'Body': {'Count': 10}},
+            {'Name': 'GetCatalogItems', 'Body': {'CatalogVersion': 'Main'}}, {'Name': 'GetUserInventory', 'Body': {}},
+            {'Name': 'GetUserData', 'Body': {'Keys': keys}} ]}
+
+    def anonymous(body):
+        return lambda: (None, body())
+
+    def leaderboardPage():
+        return {'StatisticName': random.choice(STATISTICS), 'StartPosition': random.randint(0, max(0, len(world.accounts) - 10)), 'MaxResultsCount': 10}
+
+    result = {
+        'LoginWithPlayFab': anonymous(lambda: {'Username': world.anyAccount()['Username'], 'Password': PASSWORD}),
+        'RegisterPlayFabUser': anonymous(lambda: {'Username': 'new%d' % world.nextId(), 'Email': 'new%d@example.com' % world.nextId(), 'Password': PASSWORD}),
+        'LoginWithAndroidDeviceID': anonymous(lambda: {'AndroidDeviceId': 'android%d' % world.anyAccount()['N'], 'OS': '5.0', 'AndroidDevice': 'Benchmark', 'CreateAccount': False}),
+        'LoginWithIOSDeviceID': anonymous(lambda: {'DeviceId': 'ios%d' % world.anyAccount()['N'], 'OS': '9.0', 'DeviceModel': 'Benchmark', 'CreateAccount': False}),
+        'AddUsernamePassword': fresh(lambda player: {'Username': 'added%d' % player['N'], 'Email': 'added%d@example.com' % player['N'], 'Password': PASSWORD}),
+        'UpdateEmailAddress': account(lambda: {'Email': 'changed%d@example.com' % world.nextId()}),
+        'UpdatePassword': account({'Password': PASSWORD}),
+        'UpdateUserTitleDisplayName': account(lambda: {'DisplayName': 'Player %d' % world.nextId()}),
+        'UpdateUserData': account(lambda: {'Data': {random.choice(keys): 'y' * world.options.value_size + str(world.nextId())}}),
+        'GetUserData': account({'Keys': keys}),
+        'LinkAndroidDeviceID': fresh(lambda player: {'AndroidDeviceId': 'linked%d' % player['N'], 'OS': '5.0', 'AndroidDevice': 'Benchmark'}),
+        'GetCatalogItems': account({'CatalogVersion': 'Main'}),
+        'ConsumeItem': lambda: (lambda player: (player, {'ItemId': player['ItemId'], 'ConsumeCount': 1}))(world.anyAccount()),
+        'PurchaseItem': account(purchase),
+        'GetUserInventory': account({}),
+        'GetTitleNews': account({'Count': 10}),
+        'GetTitleData': account({'Keys': ['key1', 'key2', 'key3']}),
+        'AddUserVirtualCurrency': account({'VirtualCurrency': 'GC', 'Amount': 10}),
+        'SubtractUserVirtualCurrency': account({'VirtualCurrency': 'GC', 'Amount': 10}),
+        # No Apple certificate in a synthetic world, this measures the rejection path
+        'ValidateIOSReceipt': account({'ReceiptData': b64encode(b'{"signature" = "AAAA"; "purchase-info" = "e30=";}').decode('ascii'), 'CurrencyCode': 'USD', 'PurchasePrice': 99}),
+        'ResetUser': fresh(lambda player: {}),
+        'ExecuteBatch': account(launchBatch),
+        'UpdateUserStatistics': account(lambda: {'UserStatistics': {'Score': random.randint(0, 10 ** 6), 'Kills': random.randint(0, 10 ** 6)}}),
+        'GetUserStatistics': account({}),
+        'GetLeaderboard': account(leaderboardPage),
+        'GetLeaderboardAroundCurrentUser': account(lambda: {'StatisticName': random.choice(STATISTICS), 'MaxResultsCount': 10}),
+    }
+    if world.signingKey is not None:
+        result['ValidateGooglePlayPurchase'] = account(world.googleReceipt)
+        result['ValidateGooglePlayPurchaseBatch'] = account(lambda: {'Receipts': [ world.googleReceipt() for i in range(5) ]})
+    return result
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100.0 * (len(ordered) - 1))))]
+
+def measure(client, name, make, iterations):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    latencies = []
+    queries = []
+    errors = {}
+    for i in range(iterations):
+        player, body = make()
+        extra = {'HTTP_X_AUTHORIZATION': player['Ticket']} if player else {}
+
+        with CaptureQueriesContext(connection) as context:
+            start = time.time()
+            response = client.post('/' + name, json.dumps(body), content_type='application/json', **extra)
+            latencies.append((time.time() - start) * 1000.0)
+        queries.append(len(context.captured_queries))
+
+        try:
+            errorCode = json.loads(response.content.decode('utf-8')).get('errorCode', 0)
+        except ValueError:
+            errorCode = 'HTTP %d' % response.status_code
+        errors[str(errorCode)] = errors.get(str(errorCode), 0) + 1
+
+    return {'Count': iterations, 'Mean': sum(latencies) / len(latencies), 'P50': percentile(latencies, 50),
+        'P95': percentile(latencies, 95), 'P99': percentile(latencies, 99), 'Max': max(latencies),
+        'Queries': {'Mean': float(sum(queries)) / len(queries), 'Max': max(queries)}, 'ErrorCodes': errors}
+
+def measureMetrics(client, iterations):
+    client.login(username='staff', password=PASSWORD)
+    latencies = []
+    for i in range(iterations):
+        start = time.time()
+        client.get('/Metrics')
+        latencies.append((time.time() - start) * 1000.0)
+    client.logout()
+    return {'Count': iterations, 'Mean': sum(latencies) / len(latencies), 'P50': percentile(latencies, 50),
+        'P95': percentile(latencies, 95), 'P99': percentile(latencies, 99), 'Max': max(latencies)}
+
+def currentCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    options = parseArguments()
+    random.seed(options.seed)
+
+    directory = tempfile.mkdtemp()
+    try:
+        signingKey, publicKey = makeSigningKey()
+        configure(os.path.join(directory, 'benchmark.sqlite3'), publicKey)
+
+        from django.test import Client
+        from openplaykit import urls
+
+        world = World(options, signingKey)
+        start = time.time()
+        world.seed()
+        print('Seeded world in %.1fs' % (time.time() - start))
+
+        client = Client()
+        endpoints = {}
+        skipped = {}
+        available = drivers(world)
+        for pattern in urls.urlpatterns:
+            name = pattern.name
+            if name in endpoints:
+                continue
+            if name == 'Metrics':
+                endpoints[name] = measureMetrics(client, options.iterations)
+            elif name in available:
+                endpoints[name] = measure(client, name, available[name], options.iterations)
+            elif name not in skipped:
+                skipped[name] = 'needs pycryptodome' if name.startswith('ValidateGoogle') else 'needs an external service'
+
+        print('%-32s %9s %9s %9s %8s  %s' % ('endpoint', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'error codes'))
+        for name in sorted(endpoints):
+            result = endpoints[name]
+            queries = result.get('Queries', {}).get('Mean', 0)
+            print('%-32s %9.2f %9.2f %9.2f %8.1f  %s' % (name, result['P50'], result['P95'], result['P99'], queries, result.get('ErrorCodes', '')))
+        for name in sorted(skipped):
+            print('%-32s skipped, %s' % (name, skipped[name]))
+
+        with open(options.output, 'w') as output:
+            json.dump({'Commit': currentCommit(), 'Created': datetime.datetime.utcnow().isoformat(), 'World': vars(options),
+                'Endpoints': endpoints, 'Skipped': skipped}, output, indent=2, sort_keys=True)
+        print('Results written to ' + options.output)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""
+Copyright 2016 by Bubble Zap, LLC
+See the LICENSE file distributed with this work for additional
+information regarding copyright ownership. The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Load generator replaying player sessions against a running server.
+#
+# Each simulated player logs in with a new Android device, loads title data,
+# the catalog and its inventory, then loops over purchases, UserData saves and
+# inventory refreshes picked by --mix, with a random think time between calls.
+# Reports throughput, latency percentiles per endpoint and the ErrorCodes seen.
+#
+# Players only afford purchases if the currency has an InitialDeposit, or with
+# --grant when the currency is RemotelyMutable.
+#
+# Usage: python benchmarks/loadgen.py --url http://localhost:8080/Client [--players 20]
+#            [--duration 60] [--think 500:2000] [--mix purchase=3,userdata=5,inventory=2]
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+
+try:
+    from urllib2 import Request, urlopen, HTTPError, URLError
+except ImportError:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from openplaykit.apimodel import ErrorCodes
+
+errorNames = dict((value, name) for name, value in vars(ErrorCodes).items() if not name.startswith('_'))
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description='Replay player sessions against a Client API server')
+    parser.add_argument('--url', default='http://localhost:8080/Client', help='base URL of the Client API')
+    parser.add_argument('--players', type=int, default=20, help='concurrent players')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to run')
+    parser.add_argument('--think', default='500:2000', help='think time range between calls in ms')
+    parser.add_argument('--mix', default='purchase=3,userdata=5,inventory=2', help='relative weights of the session loop actions')
+    parser.add_argument('--loops', type=int, default=20, help='loop actions per session before logging in again')
+    parser.add_argument('--catalog', default='Main', help='CatalogVersion to load and buy from')
+    parser.add_argument('--currency', default='GC', help='virtual currency used for purchases')
+    parser.add_argument('--grant', type=int, default=0, help='currency added at the start of each session')
+    parser.add_argument('--value-size', type=int, default=1024, help='bytes per UserData save')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    return parser.parse_args()
+
+def parseMix(mix):
+    weights = []
+    for entry in mix.split(','):
+        name, weight = entry.split('=')
+        weights.append((name.strip(), float(weight)))
+    return weights
+
+class Stats(object):
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, latency, error):
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(latency)
+            errors = self.errors.setdefault(endpoint, {})
+            errors[error] = errors.get(error, 0) + 1
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(round(q / 100.0 * (len(ordered) - 1))))]
+
+class Player(threading.Thread):
+
+    def __init__(self, options, stats, deadline):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.options = options
+        self.stats = stats
+        self.deadline = deadline
+        self.mix = parseMix(options.mix)
+        self.thinkMin, self.thinkMax = [ float(v) / 1000.0 for v in options.think.split(':') ]
+        self.ticket = None
+
+    def call(self, endpoint, body):
+        headers = {'Content-Type': 'application/json'}
+        if self.ticket:
+            headers['X-Authorization'] = self.ticket
+        request = Request(self.options.url.rstrip('/') + '/' + endpoint, json.dumps(body).encode('utf-8'), headers)
+
+        start = time.time()
+        try:
+            response = urlopen(request, timeout=self.options.timeout)
+            content = response.read()
+        except HTTPError as err:
+            content = err.read()
+        except (URLError, IOError) as err:
+            self.stats.record(endpoint, (time.time() - start) * 1000.0, 'Connection')
+            return None
+        latency = (time.time() - start) * 1000.0
+
+        try:
+            result = json.loads(content.decode('utf-8'))
+            error = errorNames.get(result.get('errorCode', 0), str(result.get('errorCode')))
+        except ValueError:
+            result, error = None, 'InvalidResponse'
+        self.stats.record(endpoint, latency, error)
+        return result.get('data') if result and error == 'Success' else None
+
+    def think(self):
+        time.sleep(random.uniform(self.thinkMin, self.thinkMax))
+
+    def pick(self):
+        point = random.uniform(0, sum(weight for name, weight in self.mix))
+        for name, weight in self.mix:
+            point -= weight
+            if point <= 0:
+                return name
+        return self.mix[-1][0]
+
+    def session(self):
+        self.ticket = None
+        login = self.call('LoginWithAndroidDeviceID', {'AndroidDeviceId': 'loadgen-' + str(uuid.uuid4()), 'OS': '5.0', 'AndroidDevice': 'loadgen', 'CreateAccount': True})
+        if not login:
+            self.think()
+            return
+        self.ticket = login.get('SessionTicket')
+
+        if self.options.grant:
+            self.call('AddUserVirtualCurrency', {'VirtualCurrency': self.options.currency, 'Amount': self.options.grant})
+        self.think()
+        self.call('GetTitleData', {})
+        self.think()
+
+        catalog = self.call('GetCatalogItems', {'CatalogVersion': self.options.catalog}) or {}
+        prices = [ (item['ItemId'], item['VirtualCurrencyPrices'][self.options.currency]) for item in catalog.get('Catalog', [])
+            if self.options.currency in (item.get('VirtualCurrencyPrices') or {}) ]
+        self.think()
+        self.call('GetUserInventory', {})
+
+        for loop in range(self.options.loops):
+            if time.time() >= self.deadline:
+                return
+            self.think()
+            action = self.pick()
+            if action == 'purchase' and prices:
+                itemId, price = random.choice(prices)
+                self.call('PurchaseItem', {'ItemId': itemId, 'VirtualCurrency': self.options.currency, 'Price': price, 'CatalogVersion': self.options.catalog})
+            elif action == 'userdata':
+                self.call('UpdateUserData', {'Data': {'progress%d' % random.randrange(5): 'x' * self.options.value_size}})
+            else:
+                self.call('GetUserInventory', {})
+
+    def run(self):
+        while time.time() < self.deadline:
+            self.session()
+
+def report(stats, elapsed):
+    total = sum(len(latencies) for latencies in stats.latencies.values())
+    result = {'Duration': elapsed, 'Requests': total, 'Throughput': total / elapsed, 'Endpoints': {}}
+
+    print('%d requests in %.1fs, %.1f requests/sec' % (total, elapsed, total / elapsed))
+    print('%-28s %8s %8s %9s %9s %9s  %s' % ('endpoint', 'count', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'error codes'))
+    for endpoint in sorted(stats.latencies):
+        ordered = sorted(stats.latencies[endpoint])
+        entry = {'Count': len(ordered), 'Throughput': len(ordered) / elapsed, 'P50': percentile(ordered, 50),
+            'P95': percentile(ordered, 95), 'P99': percentile(ordered, 99), 'ErrorCodes': stats.errors[endpoint]}
+        result['Endpoints'][endpoint] = entry
+        errors = ', '.join('%s=%d' % (name, count) for name, count in sorted(entry['ErrorCodes'].items()))
+        print('%-28s %8d %8.1f %9.1f %9.1f %9.1f  %s' % (endpoint, entry['Count'], entry['Throughput'], entry['P50'], entry['P95'], entry['P99'], errors))
+    return result
+
+def main():
+    options = parseArguments()
+    stats = Stats()
+
+    start = time.time()
+    players = [ Player(options, stats, start + options.duration) for i in range(options.players) ]
+    for player in players:
+        player.start()
+        # Ramp up instead of logging everybody in at once
+        time.sleep(min(1.0, options.duration / 10.0) / max(1, options.players))
+
+    try:
+        for player in players:
+            while player.is_alive():
+                player.join(1)
+    except KeyboardInterrupt:
+        print('Interrupted')
+
+    result = report(stats, time.time() - start)
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(result, output, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
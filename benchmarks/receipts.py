@@ -0,0 +1,88 @@
+"""
+Copyright 2016 by Bubble Zap, LLC
+See the LICENSE file distributed with this work for additional
+information regarding copyright ownership. The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Receipt signature verification throughput.
+#
+# Compares parsing the Google Play key for every receipt (the original
+# validateGoogleSignature) with the cached verifier in openplaykit.receipts
+# and its thread / process pools.
+#
+# Usage: python benchmarks/receipts.py [receipts] [workers]
+
+import os
+import sys
+import json
+import time
+
+from base64 import b64encode, b64decode
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from django.conf import settings
+
+from Crypto.Hash import SHA
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+
+def makeReceipts(key, count):
+    signer = PKCS1_v1_5.new(key)
+    receipts = []
+    for i in range(count):
+        receiptJson = json.dumps({'orderId': 'GPA.%d' % i, 'productId': 'com.example.gems', 'purchaseTime': 1410891177231 + i}).encode('utf-8')
+        receipts.append((receiptJson, b64encode(signer.sign(SHA.new(receiptJson)))))
+    return receipts
+
+# The per receipt work done before the verifier registry
+def verifyUncached(publicKey, signedData, signature):
+    from Crypto.Hash import SHA
+    from Crypto.PublicKey import RSA
+    from Crypto.Signature import PKCS1_v1_5
+    from openplaykit.receipts import pemFormat
+
+    key = RSA.importKey(pemFormat(publicKey))
+    verifier = PKCS1_v1_5.new(key)
+    return verifier.verify(SHA.new(signedData), b64decode(signature))
+
+def measure(name, count, run):
+    start = time.time()
+    results = run()
+    elapsed = time.time() - start
+    assert all(results), name + ' rejected a valid receipt'
+    print('%-24s %8.1f receipts/sec' % (name, count / elapsed))
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    key = RSA.generate(2048)
+    publicKey = b64encode(key.publickey().exportKey('DER')).decode('ascii')
+    receipts = makeReceipts(key, count)
+
+    settings.configure(GOOGLE_PUBLIC_KEY=publicKey, RECEIPT_VERIFY_WORKERS=workers, RECEIPT_VERIFY_POOL='thread')
+
+    from openplaykit import receipts as registry
+
+    measure('uncached', count, lambda: [ verifyUncached(publicKey, data, sig) for data, sig in receipts ])
+    measure('cached verifier', count, lambda: [ registry.verifySignature(registry.PROVIDER_GOOGLEPLAY, data, sig) for data, sig in receipts ])
+    measure('thread pool (%d)' % workers, count, lambda: registry.verifySignatures(registry.PROVIDER_GOOGLEPLAY, receipts))
+
+    settings.RECEIPT_VERIFY_POOL = 'process'
+    registry._pool = None
+    measure('process pool (%d)' % workers, count, lambda: registry.verifySignatures(registry.PROVIDER_GOOGLEPLAY, receipts))
+
+if __name__ == '__main__':
+    main()
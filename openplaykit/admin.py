@@ -18,12 +18,42 @@ limitations under the License.
 from django.contrib import admin
 from openplaykit.models import *
 from django import forms
+from django.contrib import messages
 from django.conf.urls import *
 from django.shortcuts import render
 from django.core import urlresolvers
 
+# Edits the decoded value, it is encoded (and compressed) again when saved
+class UserDataForm(forms.ModelForm):
+	class Meta:
+		model = UserData
+		exclude = ('Encoding', 'Size', 'Version')
+
+	def __init__(self, *args, **kwargs):
+		super(UserDataForm, self).__init__(*args, **kwargs)
+		if self.instance.pk != None:
+			self.initial['Data'] = self.instance.getValue()
+
+	def clean_Data(self):
+		try:
+			self.encodedData = UserData.encodeValue(self.cleaned_data['Data'])
+		except UserDataTooLarge as err:
+			raise forms.ValidationError(str(err))
+		return self.cleaned_data['Data']
+
+	def save(self, commit=True):
+		userData = super(UserDataForm, self).save(commit=False)
+		userData.Data, userData.Encoding, userData.Size = self.encodedData
+		# Clients patching against the old version have to read the edit first
+		userData.Version = userData.Version + 1
+		if commit:
+			userData.save()
+		return userData
+
 class UserDataInline(admin.TabularInline):
 	model = UserData
+	form = UserDataForm
+	readonly_fields = ('Encoding', 'Size', 'Version')
 	extra = 1
 
 class UserCurrencyInline(admin.TabularInline):
@@ -47,6 +77,24 @@ class PurchaseInline(admin.TabularInline):
 	model = Purchase
 	extra = 0
 
+class UserStatisticInline(admin.TabularInline):
+	model = UserStatistic
+	extra = 0
+
+# Compile the served catalog snapshot, reporting problems such as cyclic bundles.
+# Bundle edits are validated by BundleItemFormSet, cycles found here predate it.
+def publishCatalog(modelAdmin, request, catalog):
+	try:
+		catalog.compileSnapshot()
+	except Exception as err:
+		modelAdmin.message_user(request, 'Catalog ' + catalog.Name + ' not published. ' + str(err), level=messages.ERROR)
+		return
+
+	items = list(CatalogItem.objects.filter(Catalog=catalog))
+	cycle = CatalogItem.findBundleCycle(items, CatalogItem.prefetchRelations(items))
+	if cycle:
+		modelAdmin.message_user(request, 'Catalog ' + catalog.Name + ' has a cyclic bundle, its items cannot be granted: ' + ' > '.join(cycle), level=messages.ERROR)
+
 class ProductForm(forms.Form):
 	product = forms.CharField(max_length=100)
 
@@ -55,7 +103,7 @@ class UserAccountAdmin(admin.ModelAdmin):
 		('User', {'fields': ( 'UUID', 'DisplayName', 'Active' ) } ),
 		('Details', {'classes': ('collapse',), 'fields': ( 'SessionTicket', 'Origination', 'Created', 'FirstLogin', 'LastLogin', 'Annotations', 'LegacyProduct' ) } ),
 	)
-	inlines = [ UserCurrencyInline, UserItemsInline, UserDataInline, AndroidDeviceInline, IOSDeviceInline, PurchaseInline ]
+	inlines = [ UserCurrencyInline, UserItemsInline, UserDataInline, AndroidDeviceInline, IOSDeviceInline, PurchaseInline, UserStatisticInline ]
 	readonly_fields = ['LegacyProduct']
 	
 class ManagedUserAccountAdmin(admin.ModelAdmin):
@@ -80,6 +128,7 @@ class CatalogAdmin(admin.ModelAdmin):
 	def Items(self, obj):
 		items = CatalogItem.objects.filter(Catalog=obj.pk)
 		items = sorted(items, key=lambda x : x.ItemId )
+		relations = CatalogItem.prefetchRelations(items)
 		
 		result = """<div class="results"><table id="result_list" width="100%">
 <thead><tr>
@@ -95,9 +144,9 @@ class CatalogAdmin(admin.ModelAdmin):
 		for item in items:
 			result = result + '<tr class="row'+str(i)+'"><th><a href="/admin/openplaykit/catalogitem/'+str(item.pk)+'/">'+item.ItemId+'</a></th>'
 			result = result + '<th>'+item.DisplayName+'</th><th>'+item.Description+'</th>'
-			result = result + '<th>'+", ".join(str(i) for i in item.getItemPrices())+'</th>'
-			result = result + '<th>'+", ".join(str(i) for i in item.getCurrencyBundles())+'</th>'
-			result = result + '<th>'+", ".join(str(i) for i in item.getItemBundles())+'</th>'
+			result = result + '<th>'+", ".join(str(i) for i in relations[item.pk]['Prices'])+'</th>'
+			result = result + '<th>'+", ".join(str(i) for i in relations[item.pk]['Currencies'])+'</th>'
+			result = result + '<th>'+", ".join(str(i) for i in relations[item.pk]['Bundles'])+'</th>'
 			result = result + '</tr>'
 			i = i ^ 1;
 
@@ -110,6 +159,11 @@ class CatalogAdmin(admin.ModelAdmin):
 	def Duplicate(self, obj):
 		return '<a style="padding: 5px; -webkit-appearance: button; -moz-appearance: button; appearance: button; text-decoration: none; color: initial;" href="javascript: if( confirm(\'Duplicate catalog?\') ) { location.href += \'DuplicateCatalog\'}">Make Copy</a>'
 	Duplicate.allow_tags = True
+
+	# Rebuild the served catalog snapshot
+	def save_model(self, request, obj, form, change):
+		super(CatalogAdmin, self).save_model(request, obj, form, change)
+		publishCatalog(self, request, obj)
 	
 	def get_urls(self):
 		urls = super(CatalogAdmin, self).get_urls()
@@ -185,6 +239,8 @@ class CatalogAdmin(admin.ModelAdmin):
 				itemBund.BundledItem_id = itemLookup[itemBund.BundledItem_id]
 				itemBund.pk = None
 				itemBund.save()
+
+		publishCatalog(self, request, catalog)
 			
 		return HttpResponseRedirect('../'+str(catalog.pk) )
 
@@ -199,8 +255,22 @@ class BundleCurrencyInline(admin.TabularInline):
 	model = BundleCurrency
 	extra = 1
 
+# Refuse bundle links that would make an item contain itself before they are saved
+class BundleItemFormSet(forms.models.BaseInlineFormSet):
+	def clean(self):
+		super(BundleItemFormSet, self).clean()
+		if any(self.errors) or self.instance.pk == None:
+			return
+
+		bundledItemIds = [ form.cleaned_data['BundledItem'].pk for form in self.forms
+			if form.cleaned_data.get('BundledItem') and not form.cleaned_data.get('DELETE') ]
+		cycle = CatalogItem.findBundleCycleThrough(self.instance, bundledItemIds)
+		if cycle:
+			raise forms.ValidationError('Cyclic bundle: ' + ' > '.join(cycle))
+
 class BundleItemInline(admin.TabularInline):
 	model = BundleItem
+	formset = BundleItemFormSet
 	extra = 1
 	fk_name = "Item"
 	
@@ -217,6 +287,16 @@ class CatalogItemAdmin(admin.ModelAdmin):
 	)
 	inlines = [ ItemPriceInline, BundleCurrencyInline, BundleItemInline, ItemAttributeInline ]
 
+	# Rebuild the catalog snapshot once the item and all its inlines are saved
+	def save_related(self, request, form, formsets, change):
+		super(CatalogItemAdmin, self).save_related(request, form, formsets, change)
+		publishCatalog(self, request, form.instance.Catalog)
+
+	def delete_model(self, request, obj):
+		catalog = obj.Catalog
+		super(CatalogItemAdmin, self).delete_model(request, obj)
+		publishCatalog(self, request, catalog)
+
 
 admin.site.register(UserAccount, UserAccountAdmin)
 admin.site.register(ManagedUserAccount, ManagedUserAccountAdmin)
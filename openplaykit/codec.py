@@ -0,0 +1,110 @@
+"""
+Copyright 2016 by Bubble Zap, LLC
+See the LICENSE file distributed with this work for additional
+information regarding copyright ownership. The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+# MessagePack support is optional, without the msgpack package only JSON is offered
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+# Content types accepted as MessagePack
+MSGPACK_TYPES = ( MSGPACK, 'application/x-msgpack' )
+
+def mediaType(value):
+    return (value or '').split(';')[0].strip().lower()
+
+def requestContentType(request):
+    contentType = mediaType(request.META.get('CONTENT_TYPE'))
+    if contentType in MSGPACK_TYPES:
+        return MSGPACK
+    return contentType
+
+def isSupportedRequest(request):
+    contentType = requestContentType(request)
+    return contentType == JSON or (contentType == MSGPACK and msgpack is not None)
+
+# (content type, quality) of an Accept header entry, None for types we do not produce
+def acceptedType(value):
+    parts = value.split(';')
+    contentType = mediaType(parts[0])
+    if contentType in MSGPACK_TYPES:
+        contentType = MSGPACK
+    elif contentType != JSON:
+        return None, 0.0
+
+    quality = 1.0
+    for param in parts[1:]:
+        name, _, q = param.partition('=')
+        if name.strip().lower() == 'q':
+            try:
+                quality = float(q)
+            except ValueError:
+                quality = 0.0
+    return contentType, quality
+
+# Response format, the highest quality one from the Accept header, or else the format
+# the request was sent in. Types with q=0 are never picked; ties go to the first listed.
+def responseContentType(request):
+    if msgpack is None:
+        return JSON
+
+    best = None
+    bestQuality = 0.0
+    refused = set()
+    for value in (request.META.get('HTTP_ACCEPT') or '').split(','):
+        contentType, quality = acceptedType(value)
+        if contentType is None:
+            continue
+        if quality <= 0:
+            refused.add(contentType)
+        elif quality > bestQuality:
+            best = contentType
+            bestQuality = quality
+
+    if best is not None:
+        return best
+
+    contentType = MSGPACK if requestContentType(request) == MSGPACK else JSON
+    if contentType in refused:
+        contentType = JSON if contentType == MSGPACK else MSGPACK
+    if contentType in refused:
+        return JSON
+    return contentType
+
+def decode(contentType, body):
+    if contentType == MSGPACK:
+        return msgpack.unpackb(body, raw=False)
+
+    try:
+        return json.loads(body)
+    except UnicodeDecodeError:
+        return json.loads(body.decode('ISO-8859-1'))
+
+_jsonEncoder = DjangoJSONEncoder()
+
+def encode(contentType, data):
+    if contentType == MSGPACK:
+        # Dates and decimals are sent the same way as in JSON
+        return msgpack.packb(data, use_bin_type=True, default=_jsonEncoder.default)
+    return json.dumps(data, cls=DjangoJSONEncoder)
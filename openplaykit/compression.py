@@ -0,0 +1,125 @@
+"""
+Copyright 2016 by Bubble Zap, LLC
+See the LICENSE file distributed with this work for additional
+information regarding copyright ownership. The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import threading
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
+
+# Brotli is optional, without it only gzip is offered
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP = 'gzip'
+BROTLI = 'br'
+
+def compress(encoding, data):
+    if encoding == BROTLI:
+        return brotli.compress(data, quality=getattr(settings, 'RESPONSE_BROTLI_QUALITY', 5))
+    return compress_string(data)
+
+# Best content coding the client accepts, None for identity
+def acceptedEncoding(request):
+    accepted = {}
+    for value in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        parts = value.split(';')
+        name = parts[0].strip().lower()
+        quality = 1.0
+        for param in parts[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if name:
+            accepted[name] = quality
+
+    for encoding in (BROTLI, GZIP):
+        if encoding == BROTLI and brotli is None:
+            continue
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+# Compressed bodies of cacheable responses, keyed by their ETag and coding so
+# each version of a catalog or title data is only compressed once per process
+class CompressedBodyCache(object):
+
+    def __init__(self, maxSize=64):
+        self.maxSize = maxSize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.pop(key, None)
+            if body is not None:
+                self._entries[key] = body
+            return body
+
+    def put(self, key, body):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = body
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+bodyCache = CompressedBodyCache(getattr(settings, 'RESPONSE_COMPRESS_CACHE_SIZE', 64))
+
+# Compresses the response body in place when the client accepts it and the body is
+# at least RESPONSE_COMPRESS_THRESHOLD bytes. Pass cacheKey (the ETag) for bodies that
+# only change with their version.
+def compressResponse(request, response, cacheKey=None):
+    patch_vary_headers(response, ('Accept-Encoding',))
+
+    threshold = getattr(settings, 'RESPONSE_COMPRESS_THRESHOLD', 1024)
+    if threshold < 0 or response.status_code != 200 or response.has_header('Content-Encoding'):
+        return response
+
+    content = response.content
+    if len(content) < threshold:
+        return response
+
+    encoding = acceptedEncoding(request)
+    if encoding is None:
+        return response
+
+    body = None
+    if cacheKey is not None:
+        body = bodyCache.get((cacheKey, encoding))
+    if body is None:
+        body = compress(encoding, content)
+        if cacheKey is not None:
+            bodyCache.put((cacheKey, encoding), body)
+
+    if len(body) >= len(content):
+        return response
+
+    response.content = body
+    response['Content-Encoding'] = encoding
+    response['Content-Length'] = str(len(body))
+    return response
@@ -39,7 +39,8 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware'
+    'django.contrib.messages.middleware.MessageMiddleware',
+    'openplaykit.instrumentation.InstrumentationMiddleware'
 )
 
 TEMPLATE_CONTEXT_PROCESSORS = (
@@ -68,3 +69,61 @@ EMAIL_BACKEND = 'djangoappengine.mail.AsyncEmailBackend'
 ALLOWED_HOSTS=['.appspot.com']
 
 GOOGLE_PUBLIC_KEY=''
+
+# Per process session ticket cache used by the Client API. Deactivating an account
+# or revoking its sessions reaches the other processes only after SESSION_CACHE_TTL
+# seconds, lower it to shorten that window at the cost of more database lookups.
+SESSION_CACHE_SIZE=10000
+SESSION_CACHE_TTL=300
+
+# Signing keys for session tickets. New tickets are signed with SESSION_TICKET_KEY_ID,
+# which is required once more than one key is listed; older keys stay listed until
+# their tickets have expired. Defaults to SECRET_KEY.
+#SESSION_TICKET_KEYS={'1': 'replaceme'}
+#SESSION_TICKET_KEY_ID='1'
+SESSION_TICKET_LIFETIME=86400
+
+APPLE_CA_CERTIFICATE=''
+
+# Workers used to verify receipt signatures in bulk, 'thread' or 'process'
+RECEIPT_VERIFY_POOL='thread'
+RECEIPT_VERIFY_WORKERS=4
+
+# Size in bits of the in-process filter of claimed receipts
+RECEIPT_FILTER_BITS=8388608
+
+# UserData values from this many bytes up are stored compressed, 0 disables compression.
+# Size limits are in uncompressed bytes, 0 means no limit.
+USERDATA_COMPRESS_THRESHOLD=1024
+USERDATA_MAX_VALUE_SIZE=262144
+USERDATA_MAX_ACCOUNT_SIZE=1048576
+
+# Attempts at re-applying a merge patch that lost a race with another write
+USERDATA_PATCH_RETRIES=5
+
+# Responses from this many bytes up are gzip (or brotli) compressed, -1 disables it.
+# Compressed bodies of versioned responses such as catalogs are kept per process.
+RESPONSE_COMPRESS_THRESHOLD=1024
+RESPONSE_COMPRESS_CACHE_SIZE=64
+RESPONSE_BROTLI_QUALITY=5
+
+# ExecuteBatch limits, read-only calls in a batch share BATCH_WORKERS threads (0 runs them in order)
+BATCH_MAX_REQUESTS=20
+BATCH_WORKERS=4
+
+# Share of Client API requests measured by the instrumentation middleware, and how
+# often (seconds) the collected histograms are passed to INSTRUMENTATION_DUMP_HOOK
+INSTRUMENTATION_SAMPLE_RATE=0.01
+INSTRUMENTATION_DUMP_INTERVAL=60
+#INSTRUMENTATION_DUMP_HOOK='myproject.metrics.dumpInstrumentation'
+
+# Seconds between pushes of a process' metric counters to the shared cache
+METRICS_FLUSH_INTERVAL=10
+
+# Leaderboards are ranked in memory per process and catch up on statistics written by
+# other processes every LEADERBOARD_REFRESH_INTERVAL seconds. LEADERBOARD_CLOCK_MARGIN
+# covers clock skew between app servers. Snapshots let a new process skip the initial scan.
+LEADERBOARD_REFRESH_INTERVAL=5
+LEADERBOARD_CLOCK_MARGIN=5
+LEADERBOARD_MAX_RESULTS=100
+#LEADERBOARD_SNAPSHOT_DIR='/var/lib/openplaykit/leaderboards'
@@ -0,0 +1,176 @@
+"""
+Copyright 2016 by Bubble Zap, LLC
+See the LICENSE file distributed with this work for additional
+information regarding copyright ownership. The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import time
+import random
+import bisect
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+# Supported on Django 1.6 and later, import_by_path was replaced by import_string in 1.7
+try:
+    from django.utils.module_loading import import_string
+except ImportError:
+    from django.utils.module_loading import import_by_path as import_string
+
+# Upper bounds of the histogram buckets, the last bucket takes everything above
+TIME_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+class Histogram(object):
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # Upper bound of the bucket holding the given percentile, None past the last bound
+    def percentile(self, q):
+        if self.count == 0:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[i] if i < len(self.bounds) else None
+        return None
+
+    def dump(self):
+        return {'Count': self.count, 'Sum': self.sum, 'Bounds': list(self.bounds), 'Counts': list(self.counts),
+            'P50': self.percentile(50), 'P95': self.percentile(95), 'P99': self.percentile(99)}
+
+class EndpointStats(object):
+
+    def __init__(self):
+        self.wallTime = Histogram(TIME_BUCKETS)
+        self.dbTime = Histogram(TIME_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.requestBytes = Histogram(BYTE_BUCKETS)
+        self.responseBytes = Histogram(BYTE_BUCKETS)
+        self.errorCodes = {}
+
+    def dump(self):
+        return {'WallTime': self.wallTime.dump(), 'DbTime': self.dbTime.dump(), 'Queries': self.queries.dump(),
+            'RequestBytes': self.requestBytes.dump(), 'ResponseBytes': self.responseBytes.dump(), 'ErrorCodes': dict(self.errorCodes)}
+
+# In process registry of sampled endpoint measurements
+class Registry(object):
+
+    def __init__(self):
+        self.endpoints = {}
+        self.dumpHooks = []
+        self.lastDump = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, wallTime, dbTime, queries, requestBytes, responseBytes, errorCode):
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats()
+            stats.wallTime.observe(wallTime)
+            stats.dbTime.observe(dbTime)
+            stats.queries.observe(queries)
+            stats.requestBytes.observe(requestBytes)
+            stats.responseBytes.observe(responseBytes)
+            stats.errorCodes[errorCode] = stats.errorCodes.get(errorCode, 0) + 1
+
+    def addDumpHook(self, hook):
+        self.dumpHooks.append(hook)
+
+    # Snapshot of every endpoint, also handed to the dump hooks
+    def dump(self):
+        with self._lock:
+            data = dict((endpoint, stats.dump()) for endpoint, stats in self.endpoints.items())
+            self.lastDump = time.time()
+        for hook in self.dumpHooks:
+            hook(data)
+        return data
+
+    def reset(self):
+        with self._lock:
+            self.endpoints.clear()
+
+registry = Registry()
+
+if getattr(settings, 'INSTRUMENTATION_DUMP_HOOK', None):
+    registry.addDumpHook(import_string(settings.INSTRUMENTATION_DUMP_HOOK))
+
+# Forget the queries logged since firstQuery. The log is a plain list up to Django 1.7
+# and a deque behind connection.queries_log (connection.queries is a copy) from 1.8.
+def dropQueries(firstQuery):
+    queriesLog = getattr(connection, 'queries_log', None)
+    if queriesLog is None:
+        del connection.queries[firstQuery:]
+    else:
+        while len(queriesLog) > firstQuery:
+            queriesLog.pop()
+
+# Samples INSTRUMENTATION_SAMPLE_RATE of the Client API requests and records wall
+# time, database time, query count, body sizes and the error code returned.
+# Query timing turns on the debug cursor for sampled requests only, through
+# CaptureQueriesContext which knows the switch of each Django version.
+class InstrumentationMiddleware(object):
+
+    def __init__(self):
+        self.sampleRate = getattr(settings, 'INSTRUMENTATION_SAMPLE_RATE', 0.01)
+        self.dumpInterval = getattr(settings, 'INSTRUMENTATION_DUMP_INTERVAL', 60)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if view_func.__module__ != 'openplaykit.views' or random.random() >= self.sampleRate:
+            return None
+
+        capture = CaptureQueriesContext(connection)
+        capture.__enter__()
+        request.instrumentation = (view_func.__name__, time.time(), capture)
+        return None
+
+    def process_response(self, request, response):
+        sample = getattr(request, 'instrumentation', None)
+        if sample is None:
+            return response
+
+        endpoint, start, capture = sample
+        wallTime = (time.time() - start) * 1000.0
+        capture.__exit__(None, None, None)
+        queries = capture.captured_queries
+        dbTime = sum(float(query.get('time') or 0) for query in queries) * 1000.0
+
+        if not settings.DEBUG:
+            dropQueries(capture.initial_queries)
+
+        try:
+            requestBytes = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            requestBytes = 0
+        responseBytes = 0 if getattr(response, 'streaming', False) else len(response.content)
+
+        registry.record(endpoint, wallTime, dbTime, len(queries), requestBytes, responseBytes, getattr(response, 'errorCode', 0))
+
+        if registry.dumpHooks and time.time() - registry.lastDump >= self.dumpInterval:
+            registry.dump()
+        return response
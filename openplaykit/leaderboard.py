@@ -0,0 +1,327 @@
+"""
+Copyright 2016 by Bubble Zap, LLC
+See the LICENSE file distributed with this work for additional
+information regarding copyright ownership. The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import json
+import time
+import array
+import bisect
+import datetime
+import threading
+
+from django.conf import settings
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from openplaykit.models import UserStatistic
+
+# Entries are packed into one integer, (-value, accountId) in sort order, so the
+# best score has rank 0 and ties go to the lower account id.
+ACCOUNT_SPAN = 1 << 40
+
+def packEntry(accountId, value):
+    return -value * ACCOUNT_SPAN + accountId
+
+def unpackEntry(entry):
+    return entry % ACCOUNT_SPAN, -(entry // ACCOUNT_SPAN)
+
+# Order statistic index: a sorted list split into blocks of about BLOCK_SIZE
+# entries with a Fenwick tree over the block lengths. Rank, select and
+# updates are O(log n) with small constants and a few dozen bytes per entry,
+# which a node based tree or skip list can't offer in Python for millions of players.
+class RankIndex(object):
+
+    BLOCK_SIZE = 1000
+
+    def __init__(self, entries=(), isSorted=False):
+        entries = list(entries) if isSorted else sorted(entries)
+        self._blocks = [ entries[i:i + self.BLOCK_SIZE] for i in range(0, len(entries), self.BLOCK_SIZE) ]
+        self._maxes = [ block[-1] for block in self._blocks ]
+        self._len = len(entries)
+        self._buildTree()
+
+    def __len__(self):
+        return self._len
+
+    def _buildTree(self):
+        tree = [0] + [ len(block) for block in self._blocks ]
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _updateTree(self, block, delta):
+        i = block + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    # Entries in the blocks before the given one
+    def _prefix(self, block):
+        total = 0
+        i = block
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    # Block holding position and the position within it
+    def _locate(self, position):
+        block = 0
+        step = 1
+        while step * 2 < len(self._tree):
+            step *= 2
+        while step:
+            if block + step < len(self._tree) and self._tree[block + step] <= position:
+                block += step
+                position -= self._tree[block]
+            step //= 2
+        return block, position
+
+    def add(self, entry):
+        if not self._blocks:
+            self._blocks.append([entry])
+            self._maxes.append(entry)
+            self._len = 1
+            self._buildTree()
+            return
+
+        i = bisect.bisect_left(self._maxes, entry)
+        if i == len(self._maxes):
+            i -= 1
+            self._blocks[i].append(entry)
+            self._maxes[i] = entry
+        else:
+            bisect.insort(self._blocks[i], entry)
+        self._len += 1
+
+        if len(self._blocks[i]) > 2 * self.BLOCK_SIZE:
+            block = self._blocks[i]
+            self._blocks[i:i + 1] = [ block[:self.BLOCK_SIZE], block[self.BLOCK_SIZE:] ]
+            self._maxes[i:i + 1] = [ block[self.BLOCK_SIZE - 1], block[-1] ]
+            self._buildTree()
+        else:
+            self._updateTree(i, 1)
+
+    def remove(self, entry):
+        i = bisect.bisect_left(self._maxes, entry)
+        block = self._blocks[i] if i < len(self._blocks) else []
+        j = bisect.bisect_left(block, entry)
+        if j == len(block) or block[j] != entry:
+            raise KeyError(entry)
+
+        del block[j]
+        self._len -= 1
+        if not block:
+            del self._blocks[i]
+            del self._maxes[i]
+            self._buildTree()
+        else:
+            self._maxes[i] = block[-1]
+            self._updateTree(i, -1)
+
+    # Position of an entry that is in the index
+    def rank(self, entry):
+        i = bisect.bisect_left(self._maxes, entry)
+        return self._prefix(i) + bisect.bisect_left(self._blocks[i], entry)
+
+    def slice(self, start, count):
+        if start >= self._len or count <= 0:
+            return []
+        block, offset = self._locate(start)
+        result = []
+        while block < len(self._blocks) and len(result) < count:
+            result.extend(self._blocks[block][offset:offset + count - len(result)])
+            block += 1
+            offset = 0
+        return result
+
+    def __iter__(self):
+        for block in self._blocks:
+            for entry in block:
+                yield entry
+
+# Ranking of every player by one statistic. Writes made in this process are
+# applied straight away, the ones from other processes are read back from
+# UserStatistic every LEADERBOARD_REFRESH_INTERVAL seconds.
+class Leaderboard(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.index = RankIndex()
+        self.values = {}
+        self.lastUpdated = None
+        self.nextRefresh = 0
+        self._lock = threading.Lock()
+
+    def set(self, accountId, value):
+        with self._lock:
+            self._set(accountId, value)
+
+    def _set(self, accountId, value):
+        old = self.values.get(accountId)
+        if old == value:
+            return
+        if old is not None:
+            self.index.remove(packEntry(accountId, old))
+        self.index.add(packEntry(accountId, value))
+        self.values[accountId] = value
+
+    def remove(self, accountId):
+        with self._lock:
+            value = self.values.pop(accountId, None)
+            if value is not None:
+                self.index.remove(packEntry(accountId, value))
+
+    # 0 based position of the player, None when they have no value
+    def rank(self, accountId):
+        with self._lock:
+            value = self.values.get(accountId)
+            if value is None:
+                return None
+            return self.index.rank(packEntry(accountId, value))
+
+    # List of (position, accountId, value)
+    def page(self, start, count):
+        with self._lock:
+            return [ (start + i,) + unpackEntry(entry) for i, entry in enumerate(self.index.slice(start, count)) ]
+
+    def around(self, accountId, count):
+        with self._lock:
+            value = self.values.get(accountId)
+            if value is None:
+                return []
+            position = self.index.rank(packEntry(accountId, value))
+            start = max(0, min(position - count // 2, len(self.index) - count))
+            return [ (start + i,) + unpackEntry(entry) for i, entry in enumerate(self.index.slice(start, count)) ]
+
+    # Apply the statistic rows written since the last load. Writers on other
+    # servers stamp their own clock, so look back a little further; applying a
+    # row twice is harmless.
+    def refresh(self):
+        self.nextRefresh = time.time() + getattr(settings, 'LEADERBOARD_REFRESH_INTERVAL', 5)
+        rows = UserStatistic.objects.filter(Name=self.name)
+        if self.lastUpdated is not None:
+            margin = datetime.timedelta(seconds=getattr(settings, 'LEADERBOARD_CLOCK_MARGIN', 5))
+            rows = rows.filter(LastUpdated__gte=self.lastUpdated - margin)
+
+        latest = self.lastUpdated
+        if self.lastUpdated is None and len(self.values) == 0:
+            # Initial build, sort once instead of inserting one by one
+            values = {}
+            entries = []
+            for accountId, value, updated in rows.values_list('Account', 'Value', 'LastUpdated').iterator():
+                values[accountId] = value
+                entries.append(packEntry(accountId, value))
+                latest = updated if latest is None or updated > latest else latest
+            index = RankIndex(entries)
+            with self._lock:
+                self.values = values
+                self.index = index
+        else:
+            for accountId, value, updated in rows.values_list('Account', 'Value', 'LastUpdated').iterator():
+                self.set(accountId, value)
+                latest = updated if latest is None or updated > latest else latest
+
+        self.lastUpdated = latest
+
+    def snapshotPath(self):
+        directory = getattr(settings, 'LEADERBOARD_SNAPSHOT_DIR', None)
+        if not directory:
+            return None
+        return os.path.join(directory, self.name + '.snapshot')
+
+    # Snapshot: a JSON header line followed by the account ids and values in rank order
+    def saveSnapshot(self):
+        path = self.snapshotPath()
+        if path is None:
+            return False
+
+        with self._lock:
+            accountIds = array.array('q')
+            values = array.array('q')
+            for entry in self.index:
+                accountId, value = unpackEntry(entry)
+                accountIds.append(accountId)
+                values.append(value)
+            header = {'Name': self.name, 'Count': len(accountIds),
+                'LastUpdated': self.lastUpdated.isoformat() if self.lastUpdated else None}
+
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as snapshot:
+            snapshot.write(json.dumps(header).encode('utf-8') + b'\n')
+            accountIds.tofile(snapshot)
+            values.tofile(snapshot)
+        os.rename(temporary, path)
+        return True
+
+    def loadSnapshot(self):
+        path = self.snapshotPath()
+        if path is None or not os.path.exists(path):
+            return False
+
+        with open(path, 'rb') as snapshot:
+            header = json.loads(snapshot.readline().decode('utf-8'))
+            accountIds = array.array('q')
+            values = array.array('q')
+            accountIds.fromfile(snapshot, header['Count'])
+            values.fromfile(snapshot, header['Count'])
+
+        with self._lock:
+            self.values = dict(zip(accountIds, values))
+            self.index = RankIndex([ packEntry(accountId, value) for accountId, value in zip(accountIds, values) ], isSorted=True)
+            self.lastUpdated = parse_datetime(header['LastUpdated']) if header['LastUpdated'] else None
+        return True
+
+_leaderboards = {}
+_leaderboardsLock = threading.Lock()
+
+# Leaderboard of a statistic, loaded from its snapshot (when configured) or built
+# from the database on first use, then kept current from the statistic writes
+def getLeaderboard(name):
+    leaderboard = _leaderboards.get(name)
+    if leaderboard is None:
+        with _leaderboardsLock:
+            leaderboard = _leaderboards.get(name)
+            if leaderboard is None:
+                leaderboard = Leaderboard(name)
+                leaderboard.loadSnapshot()
+                leaderboard.refresh()
+                _leaderboards[name] = leaderboard
+
+    if time.time() >= leaderboard.nextRefresh:
+        leaderboard.refresh()
+    return leaderboard
+
+# Called after statistics were written by this process
+def statisticsChanged(accountId, statistics):
+    for name, value in statistics.items():
+        leaderboard = _leaderboards.get(name)
+        if leaderboard is not None:
+            leaderboard.set(accountId, value)
+
+# Deleted statistics, including those of deleted accounts, leave the leaderboards of
+# this process. Other processes drop the players from the pages they return once
+# their accounts are gone.
+@receiver(post_delete, sender=UserStatistic)
+def statisticDeleted(sender, instance, **kwargs):
+    leaderboard = _leaderboards.get(instance.Name)
+    if leaderboard is not None:
+        leaderboard.remove(instance.Account_id)
@@ -0,0 +1,36 @@
+"""
+Copyright 2016 by Bubble Zap, LLC
+See the LICENSE file distributed with this work for additional
+information regarding copyright ownership. The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from django.core.management.base import BaseCommand
+
+from openplaykit.models import Purchase, ReceiptClaim
+
+# Receipts redeemed before ReceiptClaim existed only live in Purchase. Run once
+# after deploying so their replays are still rejected.
+class Command(BaseCommand):
+    help = 'Create receipt claims for store purchases recorded before claims existed'
+
+    def handle(self, *args, **options):
+        purchases = Purchase.objects.filter(PaymentProvider__in=[Purchase.PROVIDER_GOOGLEPLAY, Purchase.PROVIDER_APPLE]).exclude(TransactionId='').exclude(TransactionStatus=Purchase.STATUS_FAILEDBYPROVIDER)
+
+        claimed = 0
+        for provider, transactionId, accountId in purchases.values_list('PaymentProvider', 'TransactionId', 'Account').iterator():
+            claim, created = ReceiptClaim.objects.get_or_create(PaymentProvider=provider, TransactionId=transactionId, defaults={'Account_id': accountId})
+            if created:
+                claimed = claimed + 1
+
+        self.stdout.write('Created %d receipt claims' % claimed)
@@ -0,0 +1,29 @@
+"""
+Copyright 2016 by Bubble Zap, LLC
+See the LICENSE file distributed with this work for additional
+information regarding copyright ownership. The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from django.core.management.base import BaseCommand
+
+from openplaykit.models import UserCurrencyShard
+
+# Folds sharded currency credits back into the players' UserCurrency rows.
+# Deployments run it through the CompactCurrencyShards cron endpoint instead.
+class Command(BaseCommand):
+    help = 'Compact sharded currency balances into their UserCurrency rows'
+
+    def handle(self, *args, **options):
+        moved = UserCurrencyShard.compactAll()
+        self.stdout.write('Compacted %d currency units' % moved)
@@ -0,0 +1,63 @@
+"""
+Copyright 2016 by Bubble Zap, LLC
+See the LICENSE file distributed with this work for additional
+information regarding copyright ownership. The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from itertools import groupby
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from openplaykit.models import UserItems
+
+# Collapses the one row per grant left behind before stackable items were
+# stacked into a single row per account and item.
+class Command(BaseCommand):
+    help = 'Merge duplicate inventory rows of stackable items into one stack'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only report the stacks that would be merged'),
+    )
+
+    def handle(self, *args, **options):
+        rows = UserItems.objects.filter(Item__IsStackable=True).order_by('Account', 'Item', 'pk')
+
+        merged = 0
+        for key, group in groupby(rows.iterator(), lambda row: (row.Account_id, row.Item_id)):
+            group = list(group)
+            if len(group) < 2:
+                continue
+
+            merged = merged + 1
+            if options['dry_run']:
+                self.stdout.write('Account %d item %d: %d rows' % (key[0], key[1], len(group)))
+                continue
+
+            stack = group[0]
+
+            # Durable rows have no use count, the stack stays durable
+            if any(row.RemainingUses < 0 for row in group):
+                stack.RemainingUses = -1
+            else:
+                stack.RemainingUses = sum(row.RemainingUses for row in group)
+            stack.StackCount = max(1, sum(row.StackCount for row in group if row.RemainingUses != 0))
+
+            with transaction.atomic():
+                stack.save(update_fields=['RemainingUses', 'StackCount'])
+                UserItems.objects.filter(pk__in=[row.pk for row in group[1:]]).delete()
+
+        self.stdout.write('%d stacks %s' % (merged, 'to merge' if options['dry_run'] else 'merged'))
@@ -0,0 +1,40 @@
+"""
+Copyright 2016 by Bubble Zap, LLC
+See the LICENSE file distributed with this work for additional
+information regarding copyright ownership. The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from django.core.management.base import BaseCommand
+
+from openplaykit.models import UserData, UserDataTooLarge
+
+# Encodes UserData rows written before values were compressed, filling in
+# their Size so the per account limit counts them.
+class Command(BaseCommand):
+    help = 'Compress stored UserData values and record their sizes'
+
+    def handle(self, *args, **options):
+        converted = 0
+        for row in UserData.objects.filter(Encoding=UserData.ENCODING_PLAIN).iterator():
+            try:
+                data, encoding, size = UserData.encodeValue(row.Data)
+            except UserDataTooLarge:
+                # Limits only apply to new writes, keep oversized rows as they are
+                data, encoding, size = row.Data, row.Encoding, len(row.Data.encode('utf-8'))
+
+            if encoding != row.Encoding or size != row.Size:
+                UserData.objects.filter(pk=row.pk).update(Data=data, Encoding=encoding, Size=size)
+                converted = converted + 1
+
+        self.stdout.write('Updated %d UserData rows' % converted)
@@ -0,0 +1,84 @@
+"""
+Copyright 2016 by Bubble Zap, LLC
+See the LICENSE file distributed with this work for additional
+information regarding copyright ownership. The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from itertools import groupby
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction, DatabaseError, IntegrityError
+
+from openplaykit.models import UserData
+
+# Prepares databases created before UserData keys were unique: removes the
+# duplicate rows of each (Account, Key), keeping the most recently updated one,
+# then adds the unique index syncdb does not add to existing tables.
+class Command(BaseCommand):
+    help = 'Remove duplicate UserData keys and add the unique (Account, Key) index'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only report the duplicate keys'),
+        make_option('--no-index', action='store_false', dest='index', default=True,
+            help='Remove duplicates without adding the index'),
+    )
+
+    def dedupe(self, dryRun):
+        rows = UserData.objects.order_by('Account', 'Key').only('Account', 'Key', 'LastUpdated')
+
+        removed = 0
+        for key, group in groupby(rows.iterator(), lambda row: (row.Account_id, row.Key)):
+            group = list(group)
+            if len(group) < 2:
+                continue
+
+            keep = UserData.latestByKey(group)[key[1]]
+            duplicates = [ row.pk for row in group if row.pk != keep.pk ]
+            removed = removed + len(duplicates)
+            if dryRun:
+                self.stdout.write('Account %d key %s: %d rows' % (key[0], key[1], len(group)))
+            else:
+                UserData.objects.filter(pk__in=duplicates).delete()
+        return removed
+
+    def addIndex(self):
+        quote = connection.ops.quote_name
+        table = UserData._meta.db_table
+        columns = [ UserData._meta.get_field(name).column for name in ('Account', 'Key') ]
+        sql = 'CREATE UNIQUE INDEX %s ON %s (%s)' % (quote(table + '_account_key_uniq'), quote(table), ', '.join(quote(column) for column in columns))
+
+        with transaction.atomic():
+            connection.cursor().execute(sql)
+
+    def handle(self, *args, **options):
+        removed = self.dedupe(options['dry_run'])
+        self.stdout.write('%d duplicate rows %s' % (removed, 'to remove' if options['dry_run'] else 'removed'))
+        if options['dry_run'] or not options['index']:
+            return
+
+        # Clients keep writing while this runs, remove duplicates that slipped in and retry
+        for attempt in range(3):
+            try:
+                self.addIndex()
+                self.stdout.write('Unique (Account, Key) index added')
+                return
+            except IntegrityError:
+                self.stdout.write('%d duplicate rows removed' % self.dedupe(False))
+            except DatabaseError as err:
+                # Already there (databases created with the constraint) or not an SQL backend
+                self.stdout.write('Index not added: %s' % err)
+                return
+        self.stdout.write('Index not added, duplicates keep appearing')
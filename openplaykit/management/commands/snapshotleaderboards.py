@@ -0,0 +1,39 @@
+"""
+Copyright 2016 by Bubble Zap, LLC
+See the LICENSE file distributed with this work for additional
+information regarding copyright ownership. The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from openplaykit.leaderboard import Leaderboard
+from openplaykit.models import UserStatistic
+
+# Writes a ranked snapshot of every statistic to LEADERBOARD_SNAPSHOT_DIR so new
+# processes load their leaderboards instead of scanning all statistics.
+class Command(BaseCommand):
+    help = 'Write leaderboard snapshots for every statistic'
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'LEADERBOARD_SNAPSHOT_DIR', None):
+            raise CommandError('LEADERBOARD_SNAPSHOT_DIR is not set')
+
+        names = args or UserStatistic.objects.values_list('Name', flat=True).distinct()
+        for name in names:
+            leaderboard = Leaderboard(name)
+            leaderboard.loadSnapshot()
+            leaderboard.refresh()
+            leaderboard.saveSnapshot()
+            self.stdout.write('%s: %d entries' % (name, len(leaderboard.index)))
@@ -0,0 +1,213 @@
+"""
+Copyright 2016 by Bubble Zap, LLC
+See the LICENSE file distributed with this work for additional
+information regarding copyright ownership. The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import time
+import hashlib
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+# Counters exposed in the Prometheus text format
+METRICS = (
+    ('openplaykit_logins_total', 'Logins by login method'),
+    ('openplaykit_purchases_total', 'Purchases entering each status by payment provider'),
+    ('openplaykit_currency_minted_total', 'Virtual currency credited to players'),
+    ('openplaykit_currency_sunk_total', 'Virtual currency debited from players'),
+    ('openplaykit_receipt_rejections_total', 'Store receipts rejected by provider and reason'),
+    ('openplaykit_session_cache_hits_total', 'Session tickets resolved from the session cache'),
+    ('openplaykit_session_cache_misses_total', 'Session tickets looked up in the database'),
+)
+
+CACHE_PREFIX = 'openplaykit.metrics.'
+INDEX_KEY = CACHE_PREFIX + 'index'
+
+# Every thread counts into its own dict so increments never take a lock. The
+# process totals are the sums over all threads, their growth since the last flush
+# is added to the shared cache with incr so the endpoint sees every worker.
+# Counts of threads that have ended are folded into _retired.
+_local = threading.local()
+_threadCounters = []
+_retired = {}
+_registerLock = threading.Lock()
+
+_flushed = {}
+_indexed = set()
+_flushLock = threading.Lock()
+_nextFlush = [0]
+
+def _counters():
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        counters = _local.counters = {}
+        with _registerLock:
+            _threadCounters.append((threading.current_thread(), counters))
+    return counters
+
+def inc(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    counters = _counters()
+    counters[key] = counters.get(key, 0) + amount
+
+    if time.time() >= _nextFlush[0]:
+        flush()
+
+# Count work done inside a transaction once it commits, rolled back work is not
+# counted. Runs right away outside a transaction.
+def incOnCommit(name, amount=1, **labels):
+    onCommit = getattr(transaction, 'on_commit', None)
+    if onCommit is not None:
+        onCommit(lambda: inc(name, amount, **labels))
+        return
+
+    connection = transaction.get_connection()
+    if connection.in_atomic_block:
+        _pending(connection).append((name, amount, labels))
+    else:
+        inc(name, amount, **labels)
+
+# Django before 1.9 has no commit hooks. Atomic is wrapped instead: increments are
+# queued on the connection, dropped from the queue when the block (or savepoint)
+# they were made in rolls back, and counted when the outermost block commits.
+def _pending(connection):
+    pending = getattr(connection, 'pendingMetrics', None)
+    if pending is None:
+        pending = connection.pendingMetrics = []
+        connection.pendingMetricMarks = []
+    return pending
+
+def _atomicEnter(self):
+    connection = transaction.get_connection(self.using)
+    pending = _pending(connection)
+    connection.pendingMetricMarks.append(len(pending))
+    try:
+        _originalAtomicEnter(self)
+    except Exception:
+        connection.pendingMetricMarks.pop()
+        raise
+
+def _atomicExit(self, excType, excValue, traceback):
+    connection = transaction.get_connection(self.using)
+    pending = _pending(connection)
+    mark = connection.pendingMetricMarks.pop() if connection.pendingMetricMarks else 0
+    outermost = not connection.pendingMetricMarks
+    # An inner block without a savepoint failed, the whole transaction rolls back
+    failed = excType is not None or (outermost and connection.needs_rollback)
+
+    try:
+        result = _originalAtomicExit(self, excType, excValue, traceback)
+    except Exception:
+        failed = True
+        raise
+    finally:
+        if failed:
+            del pending[mark:]
+        if outermost:
+            committed = list(pending)
+            del pending[:]
+            if not failed:
+                for name, amount, labels in committed:
+                    inc(name, amount, **labels)
+    return result
+
+if not hasattr(transaction, 'on_commit'):
+    _originalAtomicEnter = transaction.Atomic.__enter__
+    _originalAtomicExit = transaction.Atomic.__exit__
+    transaction.Atomic.__enter__ = _atomicEnter
+    transaction.Atomic.__exit__ = _atomicExit
+
+# Fold the counters of threads that have ended into _retired
+def _retireThreads():
+    with _registerLock:
+        for entry in list(_threadCounters):
+            thread, counters = entry
+            if not thread.is_alive():
+                for key, value in counters.items():
+                    _retired[key] = _retired.get(key, 0) + value
+                _threadCounters.remove(entry)
+        return dict(_retired), list(_threadCounters)
+
+def totals():
+    result, threadCounters = _retireThreads()
+    for thread, counters in threadCounters:
+        for key, value in list(counters.items()):
+            result[key] = result.get(key, 0) + value
+    return result
+
+def cacheKey(key):
+    return CACHE_PREFIX + hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+
+# Push this process' counts to the cache. Only one thread flushes at a time, the
+# others carry on counting.
+def flush(wait=False):
+    if not _flushLock.acquire(wait):
+        return
+    try:
+        _nextFlush[0] = time.time() + getattr(settings, 'METRICS_FLUSH_INTERVAL', 10)
+        current = totals()
+
+        # Re-read the index every time, another worker may have overwritten our keys
+        index = cache.get(INDEX_KEY) or {}
+        missing = [ key for key in current if cacheKey(key) not in index ]
+        if missing:
+            for key in missing:
+                index[cacheKey(key)] = key
+            cache.set(INDEX_KEY, index, None)
+        _indexed.update(current.keys())
+
+        for key, value in current.items():
+            delta = value - _flushed.get(key, 0)
+            if delta <= 0:
+                continue
+            try:
+                cache.incr(cacheKey(key), delta)
+            except ValueError:
+                cache.add(cacheKey(key), 0, None)
+                cache.incr(cacheKey(key), delta)
+            _flushed[key] = value
+    finally:
+        _flushLock.release()
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# All workers' counters in the Prometheus text exposition format
+def render():
+    flush(True)
+
+    index = cache.get(INDEX_KEY) or {}
+    # Keys this process knows of but lost from the index (evicted or overwritten)
+    for key in _indexed:
+        index.setdefault(cacheKey(key), key)
+
+    values = cache.get_many(list(index.keys()))
+    samples = {}
+    for hashed, (name, labels) in index.items():
+        if hashed in values:
+            samples.setdefault(name, []).append((labels, values[hashed]))
+
+    lines = []
+    for name, description in METRICS:
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s counter' % name)
+        for labels, value in sorted(samples.get(name, [])):
+            if labels:
+                lines.append('%s{%s} %d' % (name, ','.join('%s="%s"' % (label, _escape(v)) for label, v in labels), value))
+            else:
+                lines.append('%s %d' % (name, value))
+    return '\n'.join(lines) + '\n'
@@ -16,19 +16,35 @@ limitations under the License.
 """
 
 import re
+import zlib
+import base64
+import json
+import time
+import random
 import uuid
 import datetime
 
-from django.db import models
+from collections import OrderedDict
+from django.db import models, transaction, connection, IntegrityError
+from django.conf import settings
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
 
 from django.contrib.auth.hashers import (check_password, make_password)
 from django.utils import timezone
 from django.core import validators
 from django.core import exceptions
 
+from openplaykit.session import sessionCache, signSessionTicket
+from openplaykit.receipts import receiptFilter
+from openplaykit import metrics
+
 def getUUID():
     return str(uuid.uuid4())
 
+# Compiled grant plans by CatalogItem pk: (versions of the catalogs used, plan)
+grantPlanCache = {}
+
 class UserAccount(models.Model):
     UUID = models.CharField(max_length=36, unique=True, default=getUUID )
     DisplayName = models.CharField(max_length=32)
@@ -46,6 +62,16 @@ class UserAccount(models.Model):
             self.FirstLogin = timezone.now()
         self.LastLogin = timezone.now()
         return self.SessionTicket
+
+    def createSession(self):
+        lifetime = getattr(settings, 'SESSION_TICKET_LIFETIME', 86400)
+        issued = int(time.time())
+        session = UserSession.objects.create(Account=self, Expires=timezone.now() + datetime.timedelta(seconds=lifetime))
+        return signSessionTicket(self.pk, session.SessionTicket, issued, issued + lifetime)
+
+    def revokeSessions(self):
+        UserSession.objects.filter(Account=self, Revoked=False).update(Revoked=True)
+        sessionCache.invalidateAccount(self.pk)
     
     def getUserCurrencies(self):
         return UserCurrency.objects.filter(Account=self.pk)
@@ -62,20 +88,53 @@ class UserAccount(models.Model):
             currencyUser = UserCurrency.objects.get(Account=self, Currency=currency)
         except exceptions.ObjectDoesNotExist:
             currencyUser = UserCurrency.objects.create(Account=self, Currency=currency, Amount=currency.InitialDeposit)
-            
+
+        currencyUser.Currency = currency
         return currencyUser
+
+    # Balances by currency code, missing currency rows are created in a single insert
+    def getCurrencyBalances(self, currencies):
+        balances = dict( UserCurrency.objects.filter(Account=self).values_list('Currency', 'Amount') )
+
+        missing = [ UserCurrency(Account=self, Currency=currency, Amount=currency.InitialDeposit) for currency in currencies if currency.pk not in balances ]
+        if missing:
+            UserCurrency.objects.bulk_create(missing)
+            for userCurrency in missing:
+                balances[userCurrency.Currency_id] = userCurrency.Amount
+
+        # Add the uncompacted credits of sharded currencies
+        if any(currency.ShardCount > 1 for currency in currencies):
+            for currencyCode, amount in UserCurrencyShard.objects.filter(Account=self, Amount__gt=0).values_list('Currency', 'Amount'):
+                if currencyCode in balances:
+                    balances[currencyCode] = balances[currencyCode] + amount
+
+        return { currency.pk: balances[currency.pk] for currency in currencies }
     
     def getUserItems(self):
-        return UserItems.objects.filter(Account=self).exclude(RemainingUses=0)
+        return UserItems.objects.filter(Account=self).exclude(RemainingUses=0).select_related('Item', 'Item__Catalog', 'BundleParent')
 
     def __str__(self):
         return ' '.join([self.UUID, self.DisplayName])
 
-# Future replacement for UserAccount.SessionTicket
+# Drop cached sessions whenever the account changes (ticket reset, Active flag, ...)
+@receiver(post_save, sender=UserAccount)
+@receiver(post_delete, sender=UserAccount)
+def invalidateAccountSessions(sender, instance, **kwargs):
+    sessionCache.invalidateAccount(instance.pk)
+
+# Backs the signed session tickets, an account may hold several at once.
+# Only consulted to check for revocation, the ticket itself carries the expiry.
 class UserSession(models.Model):
     SessionTicket = models.CharField(max_length=36, unique=True, default=getUUID )
     Account = models.ForeignKey(UserAccount)
     Created = models.DateTimeField(default=timezone.now)
+    Expires = models.DateTimeField(null=True, blank=True)
+    Revoked = models.BooleanField(default=False)
+
+@receiver(post_save, sender=UserSession)
+@receiver(post_delete, sender=UserSession)
+def invalidateUserSession(sender, instance, **kwargs):
+    sessionCache.invalidateAccount(instance.Account_id)
 
 class ManagedUserAccount(models.Model):
     Username = models.CharField(max_length=30, unique=True,
@@ -113,20 +172,232 @@ class ManagedUserAccount(models.Model):
             return 'Unset'
         return self.Username
  
+class UserDataTooLarge(Exception):
+    pass
+
+class UserDataConflict(Exception):
+    pass
+
 class UserData(models.Model):
     PERM_PUBLIC = 1
     PERM_PRIVATE = 0
     PERM_CHOICES = ( (PERM_PUBLIC, 'Public'), (PERM_PRIVATE, 'Private') )
 
+    ENCODING_PLAIN = 0
+    ENCODING_ZLIB = 1
+    ENCODING_CHOICES = ( (ENCODING_PLAIN, 'Plain'), (ENCODING_ZLIB, 'zlib') )
+
     Key = models.CharField(max_length=128)
     Data = models.TextField()
+    Encoding = models.IntegerField(choices=ENCODING_CHOICES, default=ENCODING_PLAIN)
+    Size = models.IntegerField(default=0)
+    Version = models.IntegerField(default=0)
     Permission = models.IntegerField(choices=PERM_CHOICES, default=PERM_PUBLIC)
     LastUpdated = models.DateTimeField(default=timezone.now, auto_now=True)
     Account = models.ForeignKey(UserAccount)
 
+    class Meta:
+        unique_together = (('Account', 'Key'),)
+
+    # Returns (Data, Encoding, Size) to store for a value. Values from
+    # USERDATA_COMPRESS_THRESHOLD bytes up are stored zlib compressed and base64 encoded.
+    @staticmethod
+    def encodeValue(value):
+        if not isinstance(value, basestring):
+            value = unicode(value)
+        raw = value.encode('utf-8')
+        size = len(raw)
+
+        maxSize = getattr(settings, 'USERDATA_MAX_VALUE_SIZE', 0)
+        if maxSize and size > maxSize:
+            raise UserDataTooLarge('Value exceeds %d bytes' % maxSize)
+
+        threshold = getattr(settings, 'USERDATA_COMPRESS_THRESHOLD', 1024)
+        if threshold and size >= threshold:
+            packed = base64.b64encode(zlib.compress(raw, 6))
+            if len(packed) < size:
+                return packed, UserData.ENCODING_ZLIB, size
+        return value, UserData.ENCODING_PLAIN, size
+
+    def getValue(self):
+        if self.Encoding == UserData.ENCODING_ZLIB:
+            return zlib.decompress(base64.b64decode(self.Data)).decode('utf-8')
+        return self.Data
+
+    def setValue(self, value):
+        self.Data, self.Encoding, self.Size = UserData.encodeValue(value)
+
+    # Stored value parsed as JSON, None when it is not valid JSON
+    def getJsonValue(self):
+        try:
+            return json.loads(self.getValue())
+        except ValueError:
+            return None
+
+    # RFC 7396 JSON merge patch
+    @staticmethod
+    def mergePatch(target, patch):
+        if not isinstance(patch, dict):
+            return patch
+        if not isinstance(target, dict):
+            target = {}
+
+        result = dict(target)
+        for key, value in patch.items():
+            if value is None:
+                result.pop(key, None)
+            else:
+                result[key] = UserData.mergePatch(result.get(key), value)
+        return result
+
+    # Raises UserDataTooLarge when replacing the given keys with values of the given
+    # (uncompressed) sizes takes the account over USERDATA_MAX_ACCOUNT_SIZE
+    @staticmethod
+    def checkAccountSize(account, sizes):
+        maxAccountSize = getattr(settings, 'USERDATA_MAX_ACCOUNT_SIZE', 0)
+        if maxAccountSize:
+            total = sum(size for key, size in UserData.objects.filter(Account=account).values_list('Key', 'Size') if key not in sizes)
+            if total + sum(sizes.values()) > maxAccountSize:
+                raise UserDataTooLarge('Account data exceeds %d bytes' % maxAccountSize)
+
+    # Pick one row per key, the most recently updated (then highest pk) wins over duplicates
+    @staticmethod
+    def latestByKey(rows):
+        latest = {}
+        for row in sorted(rows, key=lambda row: (row.LastUpdated, row.pk)):
+            latest[row.Key] = row
+        return latest
+
+    # Write many keys with one read, one insert for new keys and an update per changed
+    # key, all in one transaction. Unchanged values are not written at all.
+    @staticmethod
+    def bulkUpsert(account, data):
+        # Encode (and compress) before opening the transaction
+        encoded = {}
+        for key, value in data.items():
+            encoded[key] = UserData.encodeValue(value)
+
+        with transaction.atomic():
+            rows = list(UserData.objects.filter(Account=account, Key__in=list(data.keys())).only('Key', 'Data', 'Encoding', 'LastUpdated'))
+            latest = UserData.latestByKey(rows)
+
+            UserData.checkAccountSize(account, { key: size for key, (stored, encoding, size) in encoded.items() })
+
+            # Clear duplicate records
+            duplicates = [ row.pk for row in rows if latest[row.Key].pk != row.pk ]
+            if duplicates:
+                UserData.objects.filter(pk__in=duplicates).delete()
+
+            now = timezone.now()
+            newRows = []
+            for key, (stored, encoding, size) in encoded.items():
+                row = latest.get(key)
+                if row == None:
+                    newRows.append(UserData(Account=account, Key=key, Data=stored, Encoding=encoding, Size=size, Version=1))
+                elif row.Data != stored or row.Encoding != encoding:
+                    UserData.objects.filter(pk=row.pk).update(Data=stored, Encoding=encoding, Size=size, Version=models.F('Version') + 1, LastUpdated=now)
+
+            if newRows:
+                try:
+                    with transaction.atomic():
+                        UserData.objects.bulk_create(newRows)
+                except IntegrityError:
+                    # A concurrent write created some of the keys first, write over them
+                    for row in newRows:
+                        if UserData.objects.filter(Account=account, Key=row.Key).update(Data=row.Data, Encoding=row.Encoding, Size=row.Size, Version=models.F('Version') + 1, LastUpdated=now) == 0:
+                            row.save()
+
+    # Apply JSON merge patches to the stored values of several keys, returns the new
+    # version of each key. versions holds the version the client last read for a key;
+    # if the stored version differs UserDataConflict is raised. Keys without one are
+    # re-read and patched again when a concurrent write gets in first. All keys are
+    # written in one transaction, a conflict on any of them leaves every key unchanged.
+    @staticmethod
+    def bulkPatch(account, patches, versions=None):
+        versions = versions or {}
+        fields = ('Key', 'Data', 'Encoding', 'Version', 'LastUpdated')
+        latest = UserData.latestByKey(UserData.objects.filter(Account=account, Key__in=list(patches.keys())).only(*fields))
+
+        # Fail before writing anything when the client is already behind
+        for key, version in versions.items():
+            row = latest.get(key)
+            if key in patches and version != (row.Version if row else 0):
+                raise UserDataConflict('Version mismatch for key ' + key)
+
+        results = {}
+        with transaction.atomic():
+            for key, patch in patches.items():
+                row = latest.get(key)
+                for attempt in range(getattr(settings, 'USERDATA_PATCH_RETRIES', 5)):
+                    current = row.Version if row else 0
+                    if key in versions and versions[key] != current:
+                        raise UserDataConflict('Version mismatch for key ' + key)
+
+                    value = UserData.mergePatch(row.getJsonValue() if row else None, patch)
+                    stored, encoding, size = UserData.encodeValue(json.dumps(value, separators=(',', ':')))
+                    UserData.checkAccountSize(account, {key: size})
+
+                    if row == None:
+                        try:
+                            with transaction.atomic():
+                                UserData.objects.create(Account=account, Key=key, Data=stored, Encoding=encoding, Size=size, Version=1)
+                            results[key] = 1
+                            break
+                        except IntegrityError:
+                            # A concurrent first write created the key, patch over its value
+                            row = UserData.objects.select_for_update().filter(Account=account, Key=key).only(*fields).first()
+                            continue
+
+                    # Only write over the version the patch was applied to
+                    if UserData.objects.filter(pk=row.pk, Version=current).update(Data=stored, Encoding=encoding, Size=size, Version=current + 1, LastUpdated=timezone.now()):
+                        results[key] = current + 1
+                        break
+
+                    # Locking read, sees the latest committed version inside the transaction
+                    row = UserData.objects.select_for_update().filter(pk=row.pk).only(*fields).first()
+                else:
+                    raise UserDataConflict('Too many concurrent updates to key ' + key)
+
+        return results
+
     def __str__(self):
         return ' '.join([self.Key, self.Account.UUID])   
    
+class UserStatistic(models.Model):
+    Name = models.CharField(max_length=64)
+    Value = models.IntegerField(default=0)
+    LastUpdated = models.DateTimeField(default=timezone.now, auto_now=True, db_index=True)
+    Account = models.ForeignKey(UserAccount)
+
+    class Meta:
+        unique_together = (('Account', 'Name'),)
+        index_together = (('Name', 'LastUpdated'),)
+
+    # Set several statistics of a player with one read, returns the ones that changed
+    @staticmethod
+    def bulkUpdate(account, statistics):
+        changed = {}
+        with transaction.atomic():
+            existing = dict(UserStatistic.objects.filter(Account=account, Name__in=list(statistics.keys())).values_list('Name', 'Value'))
+
+            now = timezone.now()
+            newRows = []
+            for name, value in statistics.items():
+                if name not in existing:
+                    newRows.append(UserStatistic(Account=account, Name=name, Value=value))
+                elif existing[name] != value:
+                    UserStatistic.objects.filter(Account=account, Name=name).update(Value=value, LastUpdated=now)
+                else:
+                    continue
+                changed[name] = value
+
+            if newRows:
+                UserStatistic.objects.bulk_create(newRows)
+        return changed
+
+    def __str__(self):
+        return ' '.join([self.Name, str(self.Value)])
+
 class AndroidDevice(models.Model):
     AndroidDeviceId = models.CharField(max_length=256, primary_key=True)
     OS = models.CharField(max_length=16)
@@ -168,6 +439,7 @@ class CurrencyType(models.Model):
     Description = models.CharField(max_length=64)
     RemotelyMutable = models.BooleanField(default=True)
     DirectTransactionLimit = models.IntegerField(default=0)
+    ShardCount = models.IntegerField(default=1, help_text='Spread credits over this many rows per player for heavily granted currencies. 1 disables sharding. Only used on SQL databases.')
 
     def __str__(self):
         return ' '.join([self.CurrencyCode, self.Description])
@@ -179,27 +451,195 @@ class UserCurrency(models.Model):
     LastUpdated = models.DateTimeField(default=timezone.now, auto_now=True)
     
     def canBuy(self, price):
-        return price <= self.Account
+        return price <= self.Amount
     
-    def debit(self, price):
-        self.Amount = self.Amount - price
-        self.save()
+    def debit(self, price, reason=0, reference=''):
+        if self.change(-price, reason, reference):
+            return True
+
+        # Credits may still be sitting in shards
+        if self.Currency.ShardCount > 1 and self.compactShards() > 0:
+            return self.change(-price, reason, reference)
+        return False
+
+    def credit(self, price, reason=0, reference=''):
+        return self.change(price, reason, reference)
+
+    # Debit as much of amount as the balance covers, returns the amount taken
+    def debitUpTo(self, amount, reason=0, reference=''):
+        if self.debit(amount, reason, reference):
+            return amount
+        amount = min(amount, self.Amount)
+        if amount > 0 and self.debit(amount, reason, reference):
+            return amount
+        return 0
+
+    # Balance changes are a single conditional UPDATE so concurrent writers can't
+    # lose or overdraw money. Returns False when a debit is not covered.
+    def change(self, delta, reason=0, reference=''):
+        if delta > 0 and self.Currency.ShardCount > 1 and UserCurrencyShard.isSupported():
+            return self.creditShard(delta, reason, reference)
+
+        with transaction.atomic():
+            balance = UserCurrency.objects.filter(pk=self.pk)
+            if delta < 0:
+                changed = balance.filter(Amount__gte=-delta).update(Amount=models.F('Amount') + delta, LastUpdated=timezone.now())
+            else:
+                changed = balance.update(Amount=models.F('Amount') + delta, LastUpdated=timezone.now())
+
+            if changed:
+                CurrencyLedger.objects.create(Account_id=self.Account_id, Currency_id=self.Currency_id, Delta=delta, Reason=reason, Reference=reference)
+            self.Amount = balance.values_list('Amount', flat=True)[0]
+
+        if changed and delta:
+            metrics.incOnCommit('openplaykit_currency_minted_total' if delta > 0 else 'openplaykit_currency_sunk_total', abs(delta), currency=self.Currency_id)
+        return changed > 0
+
+    # Credits of sharded currencies land on a random shard so concurrent grants
+    # don't all contend for this row. Debits always come out of this row.
+    def creditShard(self, delta, reason=0, reference=''):
+        shard = random.randrange(self.Currency.ShardCount)
+        shardRows = UserCurrencyShard.objects.filter(Account=self.Account_id, Currency=self.Currency_id, Shard=shard)
+
+        with transaction.atomic():
+            if shardRows.update(Amount=models.F('Amount') + delta) == 0:
+                try:
+                    with transaction.atomic():
+                        UserCurrencyShard.objects.create(Account_id=self.Account_id, Currency_id=self.Currency_id, Shard=shard, Amount=delta)
+                except IntegrityError:
+                    shardRows.update(Amount=models.F('Amount') + delta)
+            CurrencyLedger.objects.create(Account_id=self.Account_id, Currency_id=self.Currency_id, Delta=delta, Reason=reason, Reference=reference)
+
+        metrics.incOnCommit('openplaykit_currency_minted_total', delta, currency=self.Currency_id)
+        return True
+
+    # Fold the shard credits into this row, returns the amount moved
+    def compactShards(self):
+        moved = 0
+        with transaction.atomic():
+            for shard in UserCurrencyShard.objects.filter(Account=self.Account_id, Currency=self.Currency_id, Amount__gt=0):
+                # Only take what was read, credits landing meanwhile stay in the shard
+                if UserCurrencyShard.objects.filter(pk=shard.pk, Amount__gte=shard.Amount).update(Amount=models.F('Amount') - shard.Amount):
+                    moved = moved + shard.Amount
 
-    def credit(self, price):
-        self.Amount = self.Amount + price
-        self.save() 
+            if moved:
+                UserCurrency.objects.filter(pk=self.pk).update(Amount=models.F('Amount') + moved, LastUpdated=timezone.now())
+            self.Amount = UserCurrency.objects.filter(pk=self.pk).values_list('Amount', flat=True)[0]
+
+        return moved
+
+    # Balance including credits not yet compacted
+    def getBalance(self):
+        if self.Currency.ShardCount <= 1:
+            return self.Amount
+        return self.Amount + sum(UserCurrencyShard.objects.filter(Account=self.Account_id, Currency=self.Currency_id).values_list('Amount', flat=True))
 
     def __str__(self):
         return self.Currency.CurrencyCode + ' (' + str(self.Amount) + ')'
 
+class UserCurrencyShard(models.Model):
+    Currency = models.ForeignKey(CurrencyType)
+    Account = models.ForeignKey(UserAccount)
+    Shard = models.IntegerField()
+    Amount = models.IntegerField(default=0)
+
+    # Backends the shard writes are safe on
+    SQL_VENDORS = ('sqlite', 'postgresql', 'mysql', 'oracle')
+
+    class Meta:
+        unique_together = (('Account', 'Currency', 'Shard'),)
+
+    # Shards rely on transactions, conditional F() updates and the unique
+    # constraint raising IntegrityError, which the datastore doesn't provide.
+    # Elsewhere credits go straight to the UserCurrency row.
+    @staticmethod
+    def isSupported():
+        return connection.vendor in UserCurrencyShard.SQL_VENDORS
+
+    # Fold every pending shard credit into its UserCurrency row, returns the amount moved
+    @staticmethod
+    def compactAll():
+        if not UserCurrencyShard.isSupported():
+            return 0
+
+        pending = UserCurrencyShard.objects.filter(Amount__gt=0).values_list('Account', 'Currency').distinct()
+
+        moved = 0
+        for accountId, currencyCode in pending:
+            userAccount = UserAccount(pk=accountId)
+            moved = moved + userAccount.getCurrencyByCode(currencyCode).compactShards()
+        return moved
+
+    def __str__(self):
+        return ' '.join([self.Currency_id, str(self.Shard), str(self.Amount)])
+
+# Append only record of every currency balance change for auditing
+class CurrencyLedger(models.Model):
+    REASON_OTHER = 0
+    REASON_PURCHASE = 1
+    REASON_GRANT = 2
+    REASON_CLIENT = 3
+    REASON_CHOICES = ( (REASON_OTHER, 'Other'), (REASON_PURCHASE, 'Purchase'), (REASON_GRANT, 'Grant'), (REASON_CLIENT, 'Client') )
+
+    Account = models.ForeignKey(UserAccount)
+    Currency = models.ForeignKey(CurrencyType)
+    Delta = models.IntegerField()
+    Reason = models.IntegerField(choices=REASON_CHOICES, default=REASON_OTHER)
+    Reference = models.CharField(max_length=36, blank=True)
+    Timestamp = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return ' '.join([self.Currency_id, str(self.Delta)])
+
 class Catalog(models.Model):
     Name = models.CharField(max_length=32)
     IsDefault = models.BooleanField(default=False)
     Created = models.DateTimeField(default=timezone.now)
 
+    # Serialize the whole catalog once so GetCatalogItems can serve it as is. The
+    # version is read before the items, so a snapshot never claims a version newer
+    # than its content and a concurrent edit only makes it stale.
+    def compileSnapshot(self):
+        version = self.getVersion()
+        data = json.dumps(CatalogItem.getCatalogRepresentations(CatalogItem.objects.filter(Catalog=self)))
+
+        # Replace an older snapshot in place, never one compiled from a newer version
+        with transaction.atomic():
+            if CatalogSnapshot.objects.filter(Catalog=self, Version__lte=version).update(Version=version, Data=data, Created=timezone.now()) == 0:
+                try:
+                    with transaction.atomic():
+                        CatalogSnapshot.objects.create(Catalog=self, Version=version, Data=data)
+                except IntegrityError:
+                    # Another compile stored its snapshot first
+                    pass
+        return CatalogSnapshot(Catalog=self, Version=version, Data=data)
+
+    # Snapshot of the current catalog version, compiled when missing or stale
+    def getSnapshot(self):
+        snapshot = CatalogSnapshot.objects.filter(Catalog=self).first()
+        if snapshot != None and snapshot.Version == self.getVersion():
+            return snapshot
+        return self.compileSnapshot()
+
+    def invalidateSnapshot(self):
+        CatalogSnapshot.objects.filter(Catalog=self.pk).delete()
+
+    def getVersion(self):
+        return ContentVersion.getVersion('Catalog.' + str(self.pk))
+
     def __str__(self):
         return self.Name
 
+# Precompiled JSON list of catalog item representations
+class CatalogSnapshot(models.Model):
+    Catalog = models.ForeignKey(Catalog, unique=True)
+    Version = models.IntegerField(default=0)
+    Data = models.TextField()
+    Created = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.Catalog.Name
+
 class CatalogItem(models.Model):
     ItemId = models.CharField(max_length=64)
     ItemClass = models.CharField(max_length=128, blank=True)
@@ -227,7 +667,95 @@ class CatalogItem(models.Model):
         except exceptions.ObjectDoesNotExist:
             return None
 
-    def getCatalogRepresentation(self):
+    # Load the related rows for a whole set of items in a fixed number of queries
+    @staticmethod
+    def prefetchRelations(items):
+        itemIds = [ item.pk for item in items ]
+        relations = dict( (pk, {'Prices': [], 'Currencies': [], 'Bundles': [], 'Attributes': []}) for pk in itemIds )
+
+        if not itemIds:
+            return relations
+
+        for price in ItemPrice.objects.filter(Item__in=itemIds).select_related('Currency'):
+            relations[price.Item_id]['Prices'].append(price)
+        for currency in BundleCurrency.objects.filter(Item__in=itemIds).select_related('Currency'):
+            relations[currency.Item_id]['Currencies'].append(currency)
+        for bundle in BundleItem.objects.filter(Item__in=itemIds).select_related('BundledItem', 'BundledItem__Catalog'):
+            relations[bundle.Item_id]['Bundles'].append(bundle)
+        for attribute in ItemAttribute.objects.filter(Item__in=itemIds):
+            relations[attribute.Item_id]['Attributes'].append(attribute)
+
+        return relations
+
+    # Bulk version of getCatalogRepresentation
+    @staticmethod
+    def getCatalogRepresentations(items, relations=None):
+        if hasattr(items, 'select_related'):
+            items = items.select_related('Catalog')
+        items = list(items)
+        if relations == None:
+            relations = CatalogItem.prefetchRelations(items)
+        return [ item.getCatalogRepresentation(relations[item.pk]) for item in items ]
+
+    # Returns the ItemIds along a bundle cycle, or None when the bundles form a tree
+    @staticmethod
+    def findBundleCycle(items, relations):
+        itemIds = { item.pk: item.ItemId for item in items }
+        visiting = []
+        done = set()
+
+        def visit(pk):
+            if pk in done or pk not in relations:
+                return None
+            if pk in visiting:
+                return visiting[visiting.index(pk):] + [pk]
+            visiting.append(pk)
+            for bundle in relations[pk]['Bundles']:
+                cycle = visit(bundle.BundledItem_id)
+                if cycle:
+                    return cycle
+            visiting.pop()
+            done.add(pk)
+            return None
+
+        for item in items:
+            cycle = visit(item.pk)
+            if cycle:
+                return [ itemIds.get(pk, str(pk)) for pk in cycle ]
+        return None
+
+    # Returns the ItemIds along the cycle that bundling bundledItemIds into item would
+    # close, or None. Follows the stored bundles of other items one level per query.
+    @staticmethod
+    def findBundleCycleThrough(item, bundledItemIds):
+        parents = dict( (pk, item.pk) for pk in bundledItemIds )
+        level = list(parents.keys())
+        while level and item.pk not in parents:
+            nextLevel = []
+            for parentId, childId in BundleItem.objects.filter(Item__in=level).exclude(Item=item.pk).values_list('Item', 'BundledItem'):
+                if childId not in parents:
+                    parents[childId] = parentId
+                    nextLevel.append(childId)
+            level = nextLevel
+
+        if item.pk not in parents:
+            return None
+
+        path = [item.pk]
+        pk = parents[item.pk]
+        while pk != item.pk:
+            path.append(pk)
+            pk = parents[pk]
+        path.append(item.pk)
+        path.reverse()
+
+        itemIds = dict(CatalogItem.objects.filter(pk__in=path).values_list('pk', 'ItemId'))
+        return [ itemIds.get(pk, str(pk)) for pk in path ]
+
+    def getCatalogRepresentation(self, relations=None):
+        if relations == None:
+            relations = CatalogItem.prefetchRelations([self])[self.pk]
+
         itemProps = {
             'ItemId': self.ItemId,
             'ItemClass': self.ItemClass,
@@ -238,9 +766,9 @@ class CatalogItem(models.Model):
             'IsTradable': self.IsStackable
         }
 
-        itemPrices = self.getItemPrices()
+        itemPrices = relations['Prices']
         if itemPrices:
-            itemProps['VirtualCurrencyPrices'] = { ip.Currency.CurrencyCode: ip.Price for ip in itemPrices }
+            itemProps['VirtualCurrencyPrices'] = { ip.Currency_id: ip.Price for ip in itemPrices }
 
         # If consumable
         if self.UsageCount > 0:
@@ -251,11 +779,11 @@ class CatalogItem(models.Model):
                 consumable['UsagePeriod'] = self.UsagePeriod
             itemProps['Consumable'] = consumable
         
-        bundleCurrencies = self.getCurrencyBundles()
-        itemBundles = self.getItemBundles()
+        bundleCurrencies = relations['Currencies']
+        itemBundles = relations['Bundles']
 
 	# Attributes 
-        attributes = self.getAttributes()
+        attributes = { i.Key: i.Value for i in relations['Attributes'] }
         if attributes:
             itemProps['Attributes'] = attributes
 
@@ -263,7 +791,7 @@ class CatalogItem(models.Model):
         if bundleCurrencies or itemBundles:
             bundle = {}
             if bundleCurrencies:
-                bundle['BundledVirtualCurrencies'] = { bc.Currency.CurrencyCode: bc.Amount for bc in bundleCurrencies } 
+                bundle['BundledVirtualCurrencies'] = { bc.Currency_id: bc.Amount for bc in bundleCurrencies } 
             if itemBundles:
                 bundle['BundledItems'] = [i.BundledItem.ItemId for i in itemBundles]
                 bundle['BundledItemsQuantity'] = [i.Quantity for i in itemBundles]
@@ -289,10 +817,66 @@ class CatalogItem(models.Model):
     def getItemPrices(self):
         return ItemPrice.objects.filter(Item=self.pk)
 
-    def assignToUser(self, userAccount, purchase=None):
-        
-        itemsAssigned = [self.getUserRepresentation()]
-        
+    # Flatten the bundle tree into the multiset of items to grant and the summed
+    # currency payouts. Walks one bundle level per round of queries.
+    def compileGrantPlan(self):
+        grants = OrderedDict()
+        currencies = {}
+        catalogs = set()
+
+        level = [(self, 1, frozenset([self.pk]))]
+        while level:
+            relations = CatalogItem.prefetchRelations([ item for item, count, path in level ])
+            nextLevel = []
+
+            for item, count, path in level:
+                catalogs.add(item.Catalog_id)
+                if item.pk in grants:
+                    grants[item.pk] = (item, grants[item.pk][1] + count)
+                else:
+                    grants[item.pk] = (item, count)
+
+                # Containers are granted closed, their contents come with unlocking
+                if item.IsContainer:
+                    continue
+
+                for bundle in relations[item.pk]['Bundles']:
+                    if bundle.BundledItem_id in path:
+                        raise Exception('Cyclic bundle: ' + item.ItemId + ' > ' + bundle.BundledItem.ItemId)
+                    nextLevel.append((bundle.BundledItem, count * bundle.Quantity, path | frozenset([bundle.BundledItem_id])))
+
+                if item.UsageCount >= 1:
+                    for payout in relations[item.pk]['Currencies']:
+                        currency, amount = currencies.get(payout.Currency_id, (payout.Currency, 0))
+                        currencies[payout.Currency_id] = (currency, amount + payout.Amount * item.UsageCount * count)
+
+            level = nextLevel
+
+        return {'Items': list(grants.values()), 'Currencies': list(currencies.values()), 'Catalogs': catalogs}
+
+    # Grant plans are cached until the version of any catalog they draw items from
+    # moves on. Versions are read before compiling, so a concurrent edit leaves the
+    # cached plan behind its catalog version rather than ahead of it.
+    def getGrantPlan(self):
+        cached = grantPlanCache.get(self.pk)
+        catalogs = cached[1]['Catalogs'] if cached != None else set([self.Catalog_id])
+
+        versions = ContentVersion.getVersions([ 'Catalog.' + str(catalogId) for catalogId in catalogs ])
+        if cached != None and cached[0] == versions:
+            return cached[1]
+
+        plan = self.compileGrantPlan()
+        # Bundles reach into catalogs that were not versioned above, read them and compile again
+        while not plan['Catalogs'] <= catalogs:
+            catalogs = catalogs | plan['Catalogs']
+            versions = ContentVersion.getVersions([ 'Catalog.' + str(catalogId) for catalogId in catalogs ])
+            plan = self.compileGrantPlan()
+
+        plan['Catalogs'] = catalogs
+        grantPlanCache[self.pk] = (versions, plan)
+        return plan
+
+    def getGrantState(self):
         # Calculate expiration
         if self.UsagePeriod <= 0:
             expiration = None
@@ -309,23 +893,30 @@ class CatalogItem(models.Model):
             else:
                 remainingUses = 0
 
-        UserItems.objects.create(Item=self, Account=userAccount, Purchase=purchase, RemainingUses=remainingUses, Expiration=expiration)
-        
-        # If item is not a container then consume and assign now
-        if not self.IsContainer:
-            itemBundles = self.getItemBundles()
-            if itemBundles:
-                for item in itemBundles:
-                    itemsAssigned = itemsAssigned + item.assignToUser(userAccount, purchase)
-
-            # Assign currencies
-            if self.UsageCount >= 1:
-                bundleCurrencies = self.getCurrencyBundles()
-                if bundleCurrencies:
-                    for currencyPayout in bundleCurrencies:
-                        userCurrency = userAccount.getCurrency( currencyPayout.Currency )
-                        userCurrency.credit( currencyPayout.Amount * self.UsageCount )
-                        userCurrency.save()
+        return remainingUses, expiration
+
+    def assignToUser(self, userAccount, purchase=None):
+        plan = self.getGrantPlan()
+
+        itemsAssigned = []
+        newItems = []
+        for item, count in plan['Items']:
+            itemsAssigned.extend( item.getUserRepresentation() for i in range(count) )
+
+            remainingUses, expiration = item.getGrantState()
+            # Items consumed on purchase leave used up rows behind, they are never stacked
+            if item.IsStackable and remainingUses != 0:
+                UserItems.addToStack(item, userAccount, purchase, remainingUses, expiration, count)
+            else:
+                newItems.extend( UserItems(Item=item, Account=userAccount, Purchase=purchase, RemainingUses=remainingUses, Expiration=expiration) for i in range(count) )
+
+        if newItems:
+            UserItems.objects.bulk_create(newItems)
+
+        # Assign currencies, one balance update each
+        for currency, amount in plan['Currencies']:
+            userCurrency = userAccount.getCurrency( currency )
+            userCurrency.credit( amount, CurrencyLedger.REASON_GRANT, purchase.OrderId if purchase else '' )
                     
         return itemsAssigned
     
@@ -373,6 +964,42 @@ class ItemAttribute(models.Model):
     def __str__(self):
         return ' '.join([self.Item.ItemId, self.Key])
 
+# Any change to catalog content makes its snapshot stale and moves its version on
+def catalogsChanged(catalogIds):
+    CatalogSnapshot.objects.filter(Catalog__in=catalogIds).delete()
+    for catalogId in catalogIds:
+        ContentVersion.bump('Catalog.' + str(catalogId))
+
+@receiver(post_save, sender=Catalog)
+@receiver(post_delete, sender=Catalog)
+def invalidateCatalog(sender, instance, **kwargs):
+    catalogsChanged([instance.pk])
+
+# Remember the catalog an item was loaded from, an item moved to another catalog
+# changes both of them
+@receiver(post_init, sender=CatalogItem)
+def rememberItemCatalog(sender, instance, **kwargs):
+    instance.loadedCatalogId = instance.Catalog_id
+
+@receiver(post_save, sender=CatalogItem)
+@receiver(post_delete, sender=CatalogItem)
+def invalidateCatalogItem(sender, instance, **kwargs):
+    catalogIds = set([instance.Catalog_id, getattr(instance, 'loadedCatalogId', None)])
+    catalogIds.discard(None)
+    catalogsChanged(list(catalogIds))
+    instance.loadedCatalogId = instance.Catalog_id
+
+@receiver(post_save, sender=ItemPrice)
+@receiver(post_delete, sender=ItemPrice)
+@receiver(post_save, sender=BundleItem)
+@receiver(post_delete, sender=BundleItem)
+@receiver(post_save, sender=BundleCurrency)
+@receiver(post_delete, sender=BundleCurrency)
+@receiver(post_save, sender=ItemAttribute)
+@receiver(post_delete, sender=ItemAttribute)
+def invalidateCatalogItemRelation(sender, instance, **kwargs):
+    catalogsChanged(list(CatalogItem.objects.filter(pk=instance.Item_id).values_list('Catalog', flat=True)))
+
 class Purchase(models.Model):
     
     STATUS_CREATECART = 0
@@ -434,7 +1061,7 @@ class Purchase(models.Model):
     )
 
     OrderId = models.CharField(max_length=36, unique=True, default=getUUID )
-    TransactionId = models.CharField(max_length=128)
+    TransactionId = models.CharField(max_length=128, db_index=True)
     TransactionStatus = models.IntegerField(choices=STATUS_CHOICES, default=STATUS_INIT)
     PaymentProvider = models.IntegerField(choices=PROVIDER_CHOICES, default=PROVIDER_NONE)
     Currency = models.ForeignKey(CurrencyType)
@@ -447,6 +1074,41 @@ class Purchase(models.Model):
     
     def __str__(self):
         return self.OrderId
+
+# Purchases are created in their first status and saved again on every status change
+@receiver(post_save, sender=Purchase)
+def countPurchase(sender, instance, **kwargs):
+    metrics.incOnCommit('openplaykit_purchases_total', provider=instance.get_PaymentProvider_display(), status=instance.get_TransactionStatus_display())
+
+# One row per redeemed store receipt, the unique constraint makes claiming atomic
+class ReceiptClaim(models.Model):
+    PaymentProvider = models.IntegerField(choices=Purchase.PROVIDER_CHOICES)
+    TransactionId = models.CharField(max_length=128)
+    Account = models.ForeignKey(UserAccount)
+    Created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = (('PaymentProvider', 'TransactionId'),)
+
+    # Returns False when the receipt was already claimed
+    @staticmethod
+    def claim(provider, transactionId, account):
+        key = str(provider) + ':' + transactionId
+        if receiptFilter.mightContain(key) and ReceiptClaim.objects.filter(PaymentProvider=provider, TransactionId=transactionId).exists():
+            return False
+
+        try:
+            with transaction.atomic():
+                ReceiptClaim.objects.create(PaymentProvider=provider, TransactionId=transactionId, Account=account)
+        except IntegrityError:
+            receiptFilter.add(key)
+            return False
+
+        receiptFilter.add(key)
+        return True
+
+    def __str__(self):
+        return ' '.join([str(self.PaymentProvider), self.TransactionId])
     
 class UserItems(models.Model):
     Item = models.ForeignKey(CatalogItem)
@@ -456,18 +1118,56 @@ class UserItems(models.Model):
     Expiration = models.DateTimeField(null=True, blank=True)
     Annotation = models.TextField(blank=True)
     BundleParent = models.ForeignKey(CatalogItem, related_name='bundle_parent', null=True, blank=True)
+    StackCount = models.IntegerField(default=1)
+
+    # Stackable items keep one row per account, grants only move the counters.
+    # RemainingUses of a stack is the total over all of its units. Only the oldest
+    # row is updated when duplicates from before stacking are still around.
+    @staticmethod
+    def addToStack(item, account, purchase, remainingUses, expiration, count=1):
+        updates = {'StackCount': models.F('StackCount') + count}
+        if remainingUses > 0:
+            remainingUses = remainingUses * count
+            updates['RemainingUses'] = models.F('RemainingUses') + remainingUses
+
+        with transaction.atomic():
+            stack = UserItems.objects.select_for_update().filter(Item=item, Account=account).order_by('pk').first()
+            if stack == None:
+                # Lock the account so concurrent first grants of the item create a single stack
+                list(UserAccount.objects.select_for_update().filter(pk=account.pk).values_list('pk', flat=True))
+                stack = UserItems.objects.select_for_update().filter(Item=item, Account=account).order_by('pk').first()
+
+            if stack == None:
+                UserItems.objects.create(Item=item, Account=account, Purchase=purchase, RemainingUses=remainingUses, Expiration=expiration, StackCount=count)
+            else:
+                UserItems.objects.filter(pk=stack.pk).update(**updates)
     
     def isConsumeable(self):
         return self.Item.isConsumeable()
     
+    # Atomically use up count uses, returns the remaining uses or None if there are not enough
     def consume(self, count):
-        pass
+        if UserItems.objects.filter(pk=self.pk, RemainingUses__gte=count).update(RemainingUses=models.F('RemainingUses') - count) == 0:
+            return None
+
+        self.RemainingUses = UserItems.objects.filter(pk=self.pk).values_list('RemainingUses', flat=True)[0]
+
+        # Every unit of a stack carries UsageCount uses
+        if self.Item.IsStackable and self.Item.UsageCount > 0:
+            self.StackCount = (self.RemainingUses + self.Item.UsageCount - 1) // self.Item.UsageCount
+            UserItems.objects.filter(pk=self.pk, RemainingUses=self.RemainingUses).update(StackCount=self.StackCount)
+
+        return self.RemainingUses
     
     def getUserRepresentation(self):
         itemProps = self.Item.getUserRepresentation()
+        itemProps['ItemInstanceId'] = str(self.pk)
         
         if self.RemainingUses > 0:
             itemProps['RemainingUses'] = self.RemainingUses
+
+        if self.Item.IsStackable:
+            itemProps['StackCount'] = self.StackCount
         
         #if self.Purchase:
         #    itemProps['PurchaseDate'] = self.Purchase.PurchaseDate
@@ -497,3 +1197,40 @@ class NewsItem(models.Model):
     
     def __str__(self):
         return self.Title + ' (' + str(self.Timestamp) + ')'
+
+# Write counter for content that rarely changes, used for ETags in the Client API
+class ContentVersion(models.Model):
+    Name = models.CharField(max_length=64, unique=True)
+    Version = models.IntegerField(default=0)
+
+    @staticmethod
+    def getVersion(name):
+        versions = ContentVersion.objects.filter(Name=name).values_list('Version', flat=True)
+        return versions[0] if versions else 0
+
+    # Versions of several names in one query, missing names are at version 0
+    @staticmethod
+    def getVersions(names):
+        versions = dict( (name, 0) for name in names )
+        versions.update(ContentVersion.objects.filter(Name__in=list(versions.keys())).values_list('Name', 'Version'))
+        return versions
+
+    @staticmethod
+    def bump(name):
+        if ContentVersion.objects.filter(Name=name).update(Version=models.F('Version') + 1) == 0:
+            contentVersion, created = ContentVersion.objects.get_or_create(Name=name, defaults={'Version': 1})
+            if not created:
+                ContentVersion.objects.filter(Name=name).update(Version=models.F('Version') + 1)
+
+    def __str__(self):
+        return self.Name + ' (' + str(self.Version) + ')'
+
+@receiver(post_save, sender=TitleData)
+@receiver(post_delete, sender=TitleData)
+def bumpTitleDataVersion(sender, instance, **kwargs):
+    ContentVersion.bump('TitleData')
+
+@receiver(post_save, sender=NewsItem)
+@receiver(post_delete, sender=NewsItem)
+def bumpNewsItemVersion(sender, instance, **kwargs):
+    ContentVersion.bump('NewsItem')
@@ -0,0 +1,147 @@
+"""
+Copyright 2016 by Bubble Zap, LLC
+See the LICENSE file distributed with this work for additional
+information regarding copyright ownership. The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import hashlib
+import binascii
+import threading
+
+from base64 import b64decode
+
+from django.conf import settings
+from django.core import exceptions
+
+PROVIDER_GOOGLEPLAY = 'GooglePlay'
+PROVIDER_APPLE = 'Apple'
+
+def chunks(s, n):
+    for start in range(0, len(s), n):
+        yield s[start:start+n]
+
+def pemFormat(key):
+    return '\n'.join([ '-----BEGIN PUBLIC KEY-----', '\n'.join(chunks(key, 64)), '-----END PUBLIC KEY-----' ])
+
+def loadGooglePublicKey():
+    publicKey = getattr(settings, 'GOOGLE_PUBLIC_KEY', None)
+    if not publicKey:
+        raise exceptions.ImproperlyConfigured('Missing GOOGLE_PUBLIC_KEY')
+    return pemFormat(publicKey)
+
+def loadAppleCertificate():
+    certificate = getattr(settings, 'APPLE_CA_CERTIFICATE', None)
+    if not certificate:
+        raise exceptions.ImproperlyConfigured('Missing APPLE_CA_CERTIFICATE')
+    return certificate
+
+# Provider name -> function returning the PEM key material
+keyLoaders = {
+    PROVIDER_GOOGLEPLAY: loadGooglePublicKey,
+    PROVIDER_APPLE: loadAppleCertificate,
+}
+
+# Parsed keys are expensive to build, keep one PKCS1_v1_5 verifier per provider and process
+_verifiers = {}
+_verifiersLock = threading.Lock()
+
+def registerKeyLoader(provider, loader):
+    keyLoaders[provider] = loader
+    resetVerifiers()
+
+def resetVerifiers():
+    with _verifiersLock:
+        _verifiers.clear()
+
+def getVerifier(provider):
+    verifier = _verifiers.get(provider)
+    if verifier is None:
+        from Crypto.PublicKey import RSA
+        from Crypto.Signature import PKCS1_v1_5
+
+        with _verifiersLock:
+            verifier = _verifiers.get(provider)
+            if verifier is None:
+                verifier = PKCS1_v1_5.new(RSA.importKey(keyLoaders[provider]()))
+                _verifiers[provider] = verifier
+    return verifier
+
+def verifySignature(provider, signedData, signature):
+    from Crypto.Hash import SHA
+    return getVerifier(provider).verify(SHA.new(signedData), b64decode(signature))
+
+def _verifyReceipt(args):
+    try:
+        return verifySignature(*args)
+    except (ValueError, TypeError):
+        return False
+
+# Worker pool for verifying many signatures at once. RSA verification holds the GIL,
+# so RECEIPT_VERIFY_POOL = 'process' is what actually takes it off the request
+# workers; 'thread' only overlaps it with I/O.
+_pool = None
+_poolLock = threading.Lock()
+
+def getPool():
+    global _pool
+    size = getattr(settings, 'RECEIPT_VERIFY_WORKERS', 4)
+    if size <= 0:
+        return None
+
+    if _pool is None:
+        with _poolLock:
+            if _pool is None:
+                if getattr(settings, 'RECEIPT_VERIFY_POOL', 'thread') == 'process':
+                    from multiprocessing import Pool
+                else:
+                    from multiprocessing.pool import ThreadPool as Pool
+                _pool = Pool(size)
+    return _pool
+
+# Verify a list of (signedData, signature) pairs, returns a list of booleans.
+# Malformed signatures count as invalid instead of failing the whole batch.
+def verifySignatures(provider, receipts):
+    # Load the key here so configuration errors surface to the caller
+    getVerifier(provider)
+
+    work = [ (provider, signedData, signature) for signedData, signature in receipts ]
+    pool = getPool()
+    if pool is None or len(work) < 2:
+        return [ _verifyReceipt(args) for args in work ]
+    return pool.map(_verifyReceipt, work)
+
+# Bloom filter over receipts already claimed by this process. A miss means the
+# receipt was never seen here, so the claim goes straight to the insert without
+# probing the claim table first. Hits may be false positives and are checked.
+class ReceiptFilter(object):
+
+    def __init__(self, bits=1 << 23, hashes=7):
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray(bits // 8 + 1)
+
+    def _positions(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).digest()
+        first = int(binascii.hexlify(digest[:8]), 16)
+        second = int(binascii.hexlify(digest[8:16]), 16) | 1
+        return [ (first + i * second) % self.bits for i in range(self.hashes) ]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._array[position >> 3] |= 1 << (position & 7)
+
+    def mightContain(self, key):
+        return all(self._array[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+receiptFilter = ReceiptFilter(getattr(settings, 'RECEIPT_FILTER_BITS', 1 << 23))
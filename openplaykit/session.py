@@ -0,0 +1,170 @@
+"""
+Copyright 2016 by Bubble Zap, LLC
+See the LICENSE file distributed with this work for additional
+information regarding copyright ownership. The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import copy
+import time
+import hmac
+import base64
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core import exceptions
+
+from openplaykit import metrics
+
+# Resolves session tickets to accounts without touching the database on
+# every request. The cache is per process, so entries changed by another
+# process are only picked up once their TTL runs out. Hits and misses of all
+# processes are published through metrics.
+class SessionCache(object):
+
+    def __init__(self, maxSize=10000, ttl=300):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._tickets = {}
+        self._lock = threading.Lock()
+
+    def get(self, ticket):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(ticket)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    self._remove(ticket)
+                self.misses += 1
+                account = None
+            else:
+                # Move to the most recently used end
+                del self._entries[ticket]
+                self._entries[ticket] = entry
+                self.hits += 1
+                account = entry[1]
+
+        if account is None:
+            metrics.inc('openplaykit_session_cache_misses_total')
+            return None
+        metrics.inc('openplaykit_session_cache_hits_total')
+
+        # Hand out a copy so views can modify and save their own instance
+        result = copy.copy(account)
+        result._state = copy.copy(account._state)
+        return result
+
+    def put(self, ticket, account):
+        with self._lock:
+            if ticket in self._entries:
+                self._remove(ticket)
+            self._entries[ticket] = (time.time() + self.ttl, copy.copy(account))
+            self._tickets.setdefault(account.pk, set()).add(ticket)
+
+            while len(self._entries) > self.maxSize:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, ticket):
+        with self._lock:
+            if ticket in self._entries:
+                self._remove(ticket)
+
+    # Only reaches this process. Other processes keep serving the account's
+    # cached sessions, deactivated or revoked ones included, for up to the TTL.
+    def invalidateAccount(self, accountId):
+        with self._lock:
+            for ticket in list(self._tickets.get(accountId, ())):
+                self._remove(ticket)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tickets.clear()
+
+    # Counts of this process only, see the session cache metrics for all of them
+    def stats(self):
+        return {'Hits': self.hits, 'Misses': self.misses, 'Size': len(self._entries)}
+
+    def _remove(self, ticket):
+        expires, account = self._entries.pop(ticket)
+        tickets = self._tickets.get(account.pk)
+        if tickets is not None:
+            tickets.discard(ticket)
+            if not tickets:
+                del self._tickets[account.pk]
+
+sessionCache = SessionCache(getattr(settings, 'SESSION_CACHE_SIZE', 10000), getattr(settings, 'SESSION_CACHE_TTL', 300))
+
+# Signed session tickets
+#
+# Format: AccountId.SessionId.Issued.Expires.KeyId.Signature where the signature is
+# an HMAC-SHA256 over everything before it. Tickets are signed with the current key
+# and verified against any configured key so keys can be rotated without logging
+# everybody out.
+
+def getSigningKeys():
+    keys = getattr(settings, 'SESSION_TICKET_KEYS', None)
+    if not keys:
+        keys = {'0': settings.SECRET_KEY}
+    # The signing key is named explicitly, key ids have no order to pick the newest by
+    currentKeyId = getattr(settings, 'SESSION_TICKET_KEY_ID', None)
+    if currentKeyId is None:
+        if len(keys) != 1:
+            raise exceptions.ImproperlyConfigured('SESSION_TICKET_KEY_ID must name one of the SESSION_TICKET_KEYS')
+        currentKeyId = list(keys.keys())[0]
+    elif currentKeyId not in keys:
+        raise exceptions.ImproperlyConfigured('Unknown SESSION_TICKET_KEY_ID ' + currentKeyId)
+    return currentKeyId, keys
+
+def _signature(key, payload):
+    digest = hmac.new(key.encode('utf-8'), payload.encode('utf-8'), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode('ascii').rstrip('=')
+
+def isSignedTicket(ticket):
+    return ticket.count('.') == 5
+
+def signSessionTicket(accountId, sessionId, issued, expires):
+    keyId, keys = getSigningKeys()
+    payload = '.'.join([str(accountId), sessionId, str(int(issued)), str(int(expires)), keyId])
+    return payload + '.' + _signature(keys[keyId], payload)
+
+def verifySessionTicket(ticket, now=None):
+    parts = ticket.split('.')
+    if len(parts) != 6:
+        raise ValueError('Malformed session ticket')
+
+    accountId, sessionId, issued, expires, keyId, signature = parts
+    keys = getSigningKeys()[1]
+    if keyId not in keys:
+        raise ValueError('Unknown session ticket key')
+
+    expected = _signature(keys[keyId], '.'.join(parts[:5]))
+    if not hmac.compare_digest(expected, str(signature)):
+        raise ValueError('Invalid session ticket signature')
+
+    try:
+        expires = int(expires)
+        accountId = int(accountId)
+    except ValueError:
+        raise ValueError('Malformed session ticket')
+
+    if expires < (now or time.time()):
+        raise ValueError('Session ticket expired')
+
+    return accountId, sessionId
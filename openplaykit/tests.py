@@ -0,0 +1,133 @@
+"""
+Copyright 2016 by Bubble Zap, LLC
+See the LICENSE file distributed with this work for additional
+information regarding copyright ownership. The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+
+from openplaykit.models import *
+from openplaykit.session import sessionCache
+from openplaykit import metrics
+from openplaykit import views
+
+class CatalogRepresentationTests(TestCase):
+
+    def setUp(self):
+        self.catalog = Catalog.objects.create(Name='Main')
+        self.currency = CurrencyType.objects.create(CurrencyCode='GV', InitialDeposit=0, Description='Gold')
+        self.gem = CatalogItem.objects.create(ItemId='gem', Catalog=self.catalog)
+
+    def addItems(self, count):
+        for n in range(count):
+            item = CatalogItem.objects.create(ItemId='item%d' % n, Catalog=self.catalog)
+            ItemPrice.objects.create(Item=item, Currency=self.currency, Price=10)
+            BundleCurrency.objects.create(Item=item, Currency=self.currency, Amount=5)
+            BundleItem.objects.create(Item=item, BundledItem=self.gem, Quantity=2)
+            ItemAttribute.objects.create(Item=item, Key='color', Value='red')
+
+    # The items plus one query each for prices, currencies, bundles and attributes
+    def assertCatalogQueries(self, itemCount):
+        self.addItems(itemCount)
+        with self.assertNumQueries(5):
+            items = CatalogItem.getCatalogRepresentations(CatalogItem.objects.filter(Catalog=self.catalog))
+        self.assertEqual(len(items), itemCount + 1)
+
+    def testSmallCatalogQueryCount(self):
+        self.assertCatalogQueries(1)
+
+    def testLargeCatalogQueryCount(self):
+        self.assertCatalogQueries(50)
+
+    def testBundleRepresentation(self):
+        self.addItems(1)
+        items = CatalogItem.getCatalogRepresentations(CatalogItem.objects.filter(Catalog=self.catalog, ItemId='item0'))
+        self.assertEqual(items[0]['VirtualCurrencyPrices'], {'GV': 10})
+        self.assertEqual(items[0]['Bundle']['BundledItems'], ['gem'])
+        self.assertEqual(items[0]['Bundle']['BundledItemsQuantity'], [2])
+
+class UserDataTests(TestCase):
+
+    def setUp(self):
+        sessionCache.clear()
+        self.account = UserAccount.objects.create(DisplayName='player', Origination='PlayFab')
+        UserData.bulkUpsert(self.account, dict( ('key%d' % n, 'value%d' % n) for n in range(100) ))
+
+    def getUserData(self, keys):
+        request = RequestFactory().post('/GetUserData', json.dumps({'Keys': keys}), content_type='application/json',
+            HTTP_X_AUTHORIZATION=self.account.SessionTicket)
+        return json.loads(views.GetUserData(request).content.decode('utf-8'))
+
+    # The session lookup plus one query for all requested keys
+    def assertUserDataQueries(self, keyCount):
+        sessionCache.clear()
+        keys = [ 'key%d' % n for n in range(keyCount) ]
+        with self.assertNumQueries(2):
+            response = self.getUserData(keys)
+        self.assertEqual(sorted(response['data']['Data'].keys()), sorted(keys))
+
+    def testOneKeyQueryCount(self):
+        self.assertUserDataQueries(1)
+
+    def testTenKeysQueryCount(self):
+        self.assertUserDataQueries(10)
+
+    def testHundredKeysQueryCount(self):
+        self.assertUserDataQueries(100)
+
+# Runs outside a test transaction so the outermost atomic block really commits
+class MetricsTests(TransactionTestCase):
+
+    def count(self, name):
+        return sum(value for (key, labels), value in metrics.totals().items() if key == name)
+
+    def testRolledBackIncrementsAreDropped(self):
+        before = self.count('openplaykit_purchases_total')
+        try:
+            with transaction.atomic():
+                metrics.incOnCommit('openplaykit_purchases_total', provider='Test')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.count('openplaykit_purchases_total'), before)
+
+    def testCommittedIncrementsAreCounted(self):
+        before = self.count('openplaykit_purchases_total')
+        with transaction.atomic():
+            metrics.incOnCommit('openplaykit_purchases_total', provider='Test')
+            try:
+                with transaction.atomic():
+                    metrics.incOnCommit('openplaykit_purchases_total', 10, provider='Test')
+                    raise ValueError()
+            except ValueError:
+                pass
+            self.assertEqual(self.count('openplaykit_purchases_total'), before)
+        self.assertEqual(self.count('openplaykit_purchases_total'), before + 1)
+
+    def testSessionCacheLookupsAreCounted(self):
+        account = UserAccount.objects.create(DisplayName='metrics', Origination='PlayFab')
+        hits = self.count('openplaykit_session_cache_hits_total')
+        misses = self.count('openplaykit_session_cache_misses_total')
+
+        sessionCache.put('metrics-ticket', account)
+        sessionCache.get('metrics-ticket')
+        sessionCache.get('missing-ticket')
+        sessionCache.clear()
+
+        self.assertEqual(self.count('openplaykit_session_cache_hits_total'), hits + 1)
+        self.assertEqual(self.count('openplaykit_session_cache_misses_total'), misses + 1)
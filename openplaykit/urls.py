@@ -40,6 +40,7 @@ urlpatterns = patterns('',
     url(r'^ConsumeItem$', views.ConsumeItem, name='ConsumeItem'),
     url(r'^PurchaseItem$', views.PurchaseItem, name='PurchaseItem'),
     url(r'^ValidateGooglePlayPurchase$', views.ValidateGooglePlayPurchase, name='ValidateGooglePlayPurchase'),
+    url(r'^ValidateGooglePlayPurchaseBatch$', views.ValidateGooglePlayPurchaseBatch, name='ValidateGooglePlayPurchaseBatch'),
     url(r'^ValidateIOSReceipt$', views.ValidateIOSReceipt, name='ValidateIOSReceipt'),
     url(r'^GetUserInventory$', views.GetUserInventory, name='GetUserInventory'),
     url(r'^GetTitleNews$', views.GetTitleNews, name='GetTitleNews'),
@@ -48,4 +49,11 @@ urlpatterns = patterns('',
     url(r'^SubtractUserVirtualCurrency$', views.SubtractUserVirtualCurrency, name='SubtractUserVirtualCurrency'),
     url(r'^LinkFacebookAccount$', views.LinkFacebookAccount, name='LinkFacebookAccount'),
     url(r'^ResetUser$', views.ResetUser, name='ResetUser'),
+    url(r'^ExecuteBatch$', views.ExecuteBatch, name='ExecuteBatch'),
+    url(r'^Metrics$', views.Metrics, name='Metrics'),
+    url(r'^CompactCurrencyShards$', views.CompactCurrencyShards, name='CompactCurrencyShards'),
+    url(r'^UpdateUserStatistics$', views.UpdateUserStatistics, name='UpdateUserStatistics'),
+    url(r'^GetUserStatistics$', views.GetUserStatistics, name='GetUserStatistics'),
+    url(r'^GetLeaderboard$', views.GetLeaderboard, name='GetLeaderboard'),
+    url(r'^GetLeaderboardAroundCurrentUser$', views.GetLeaderboardAroundCurrentUser, name='GetLeaderboardAroundCurrentUser'),
 )
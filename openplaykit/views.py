@@ -16,62 +16,145 @@ limitations under the License.
 """
 
 import datetime
+import hashlib
 import json
+import threading
 
-from django.http import HttpResponseBadRequest, HttpResponse
+from django.conf import settings
+from django.http import HttpRequest, HttpResponseBadRequest, HttpResponse, HttpResponseNotModified
+from django.contrib.admin.views.decorators import staff_member_required
 from django.core import exceptions
+from django.db import connection, transaction
 
 from openplaykit.apimodel import ErrorCodes
 from openplaykit.models import *
+from openplaykit.session import sessionCache, isSignedTicket, verifySessionTicket
+from openplaykit import receipts
+from openplaykit import codec
+from openplaykit import metrics
+from openplaykit.leaderboard import getLeaderboard, statisticsChanged
+from openplaykit.compression import compressResponse
 from django.db.models.base import Model
 
-from django.core.serializers.json import DjangoJSONEncoder
-
-class JsonResponse(HttpResponse):
-	def __init__(self, data, encoder=DjangoJSONEncoder, safe=True, **kwargs):
-		if safe and not isinstance(data, dict):
-			raise TypeError('In order to allow non-dict objects to be serialized set the safe parameter to False')
-		kwargs.setdefault('content_type', 'application/json')
-		data = json.dumps(data, cls=encoder)
-		super(JsonResponse, self).__init__(content=data, **kwargs)
-
-def SuccessResponse( data={} ):
+# Response encoded as JSON, or MessagePack when the client accepts it
+class EncodedResponse(HttpResponse):
+	def __init__(self, request, data, **kwargs):
+		contentType = codec.responseContentType(request)
+		kwargs.setdefault('content_type', contentType)
+		super(EncodedResponse, self).__init__(content=codec.encode(contentType, data), **kwargs)
+		self['Vary'] = 'Accept'
+
+# Responses with an ETag only change with their version, their compressed body is cached
+def FinishResponse( request, response, etag=None ):
+	if etag != None:
+		response['ETag'] = etag
+	return compressResponse(request, response, etag)
+
+def SuccessResponse( request, data={}, etag=None ):
 	success = {'code': 200, 'status': 'OK'}
 	if data != None:
 		success['data'] = data
-	return JsonResponse(success)
+	return FinishResponse(request, EncodedResponse(request, success), etag)
+
+# Wraps data that is already serialized as JSON without decoding it again
+def RawSuccessResponse( request, rawData, etag=None ):
+	if codec.responseContentType(request) != codec.JSON:
+		return SuccessResponse(request, json.loads(rawData), etag)
+	response = HttpResponse('{"code": 200, "status": "OK", "data": ' + rawData + '}', content_type=codec.JSON)
+	response['Vary'] = 'Accept'
+	return FinishResponse(request, response, etag)
 
 def ErrorHttpResponse(request, httpcode, httpstatus, error, errorCode, errorMessage, errorDetails={}):
 	# If client asks don't return the RFC HTTP code instead fake a 200 code
 	if httpcode != 200 and request.META.get('HTTP_X_HTTPERRORASSUCCESS'):
 		httpcode = 200
-	return JsonResponse({'code': httpcode, 'status': httpstatus, 'errorCode': errorCode, 'errorMessage': errorMessage, 'errorDetails': errorDetails }, status=httpcode)
-
+	response = EncodedResponse(request, {'code': httpcode, 'status': httpstatus, 'errorCode': errorCode, 'errorMessage': errorMessage, 'errorDetails': errorDetails }, status=httpcode)
+	# Picked up by the instrumentation middleware
+	response.errorCode = errorCode
+	return response
+
+def ReceiptRejectedResponse(request, provider, error, errorCode, errorMessage):
+	metrics.inc('openplaykit_receipt_rejections_total', provider=provider, reason=error)
+	return ErrorHttpResponse(request, 400, 'BadRequest', error, errorCode, errorMessage )
+
+# Opaque entity tag built from content versions and request parameters. It is weak
+# because the identity, gzip and brotli bodies of a response all carry the same tag.
+def makeETag(*parts):
+	return 'W/"' + hashlib.md5('/'.join(str(p) for p in parts).encode('utf-8')).hexdigest() + '"'
+
+def weakETag(etag):
+	return etag[2:] if etag.startswith('W/') else etag
+
+# If-None-Match uses the weak comparison
+def isNotModified(request, etag):
+	ifNoneMatch = request.META.get('HTTP_IF_NONE_MATCH')
+	if ifNoneMatch == None:
+		return False
+	return ifNoneMatch.strip() == '*' or weakETag(etag) in [ weakETag(e.strip()) for e in ifNoneMatch.split(',') ]
+
+# Carries the same validators and Vary header as the full response
+def NotModifiedResponse(etag):
+	response = HttpResponseNotModified()
+	response['ETag'] = etag
+	response['Vary'] = 'Accept, Accept-Encoding'
+	return response
+
+# Requests are POSTed as JSON or, if msgpack is installed, MessagePack
 def isNotJSONRequest(request):
-	return request.method != 'POST' or request.META.get('CONTENT_TYPE') != 'application/json'
+	return request.method != 'POST' or not codec.isSupportedRequest(request)
 
 def getAuthenticatedUser(request):
 	Authorization = request.META.get('HTTP_X_AUTHORIZATION')
 
+	# Resolved once by ExecuteBatch for all of its sub-requests
+	userAccount = getattr(request, 'authenticatedUser', None)
+	if userAccount != None:
+		return userAccount
+
 	if Authorization == None:
 		raise Exception('Authorization token missing')
 
-	try:
-		UserAccount.objects.get(SessionTicket=Authorization)
-	except exceptions.ObjectDoesNotExist:
-		raise Exception('No authorization token')
+	# Signature and expiry of signed tickets are checked before anything else
+	if isSignedTicket(Authorization):
+		try:
+			accountId, sessionId = verifySessionTicket(Authorization)
+		except ValueError as err:
+			raise Exception(str(err))
 
-	return UserAccount.objects.get(SessionTicket=Authorization)
+	userAccount = sessionCache.get(Authorization)
+	if userAccount != None:
+		return userAccount
 
-def GetJsonRequest(body):
-	try:
-		jsonrequest = json.loads(body)
-	except:
-		jsonrequest = json.loads(body, encoding="ISO-8859-1")
-		
-	if type(jsonrequest) is not dict:
+	if isSignedTicket(Authorization):
+		# Revocation check
+		try:
+			userAccount = UserSession.objects.select_related('Account').get(SessionTicket=sessionId, Account=accountId, Revoked=False).Account
+		except exceptions.ObjectDoesNotExist:
+			raise Exception('Session ticket revoked')
+	else:
+		try:
+			userAccount = UserAccount.objects.get(SessionTicket=Authorization)
+		except exceptions.ObjectDoesNotExist:
+			raise Exception('No authorization token')
+
+	# Saving the account drops its cached sessions, so deactivation applies right away
+	if not userAccount.Active:
+		raise Exception('Account is not active')
+
+	sessionCache.put(Authorization, userAccount)
+	return userAccount
+
+# Decodes the request body in its wire format, once per request
+def GetJsonRequest(request):
+	if not hasattr(request, 'decodedBody'):
+		try:
+			request.decodedBody = codec.decode(codec.requestContentType(request), request.body)
+		except Exception:
+			raise TypeError('Invalid request body')
+
+	if type(request.decodedBody) is not dict:
 		raise TypeError('Invalid request type')
-	return jsonrequest
+	return request.decodedBody
 
 def LoginWithPlayFab(request):
 
@@ -80,7 +163,7 @@ def LoginWithPlayFab(request):
 
 	# Request: {"TitleId": "1", "Username": "theuser", "Password": "thepassword" }
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidRequest, str(err) )
 
@@ -112,7 +195,8 @@ def LoginWithPlayFab(request):
 		except Exception as err:
 			return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, 'Unknown Error' )
 
-		return SuccessResponse({'SessionTicket': userAccount.SessionTicket, 'NewlyCreated': False, 'PlayFabId': userAccount.UUID })	
+		metrics.inc('openplaykit_logins_total', origination='PlayFab')
+		return SuccessResponse(request, {'SessionTicket': userAccount.createSession(), 'NewlyCreated': False, 'PlayFabId': userAccount.UUID })	
 	else:
 		return ErrorHttpResponse(request, 401, 'Unauthorized', 'InvalidUsernameOrPassword', ErrorCodes.InvalidUsernameOrPassword, 'Invalid Username Or Password' )
 
@@ -126,7 +210,7 @@ def RegisterPlayFabUser(request):
 		return HttpResponseBadRequest()
 
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 
@@ -186,7 +270,7 @@ def RegisterPlayFabUser(request):
 	managedUserAccount.save()
 
 	# {"code":200,"status":"OK","jsonrequest":{"PlayFabId":"1EBAC35E14A7B102","SessionTicket":"1EBAC35E14A7B102--4A4-B79-8D1CA1F0B26F028-2391AF3CBA512CE3.90FF8F2435625CF9","Username":"rival667"}}
-	return SuccessResponse({"PlayFabId": userAccount.UUID, 'SessionTicket': userAccount.SessionTicket, 'Username': username } )
+	return SuccessResponse(request, {"PlayFabId": userAccount.UUID, 'SessionTicket': userAccount.createSession(), 'Username': username } )
 
 def LoginWithAndroidDeviceID(request):
 	
@@ -195,7 +279,7 @@ def LoginWithAndroidDeviceID(request):
 	
 	# Request: { "TitleId": "1", "AndroidDeviceId": "59872d98fa632brn8hg3770", "OS": "4.4", "AndroidDevice": "Samsung Galaxy S3", "CreateAccount": false }
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 
@@ -234,8 +318,10 @@ def LoginWithAndroidDeviceID(request):
 	androidAccount.Account.loginRefresh()
 	androidAccount.Account.save()
 
+	metrics.inc('openplaykit_logins_total', origination='Android')
+
 	# { "SessionTicket": "4D2----8D11F4249A80000-7C64AB0A9F1D8D1A.CD803BF233CE76CC", "NewlyCreated": false }
-	return SuccessResponse({'SessionTicket': androidAccount.Account.SessionTicket, 'NewlyCreated': newlyCreated, 'PlayFabId': androidAccount.Account.UUID })
+	return SuccessResponse(request, {'SessionTicket': androidAccount.Account.createSession(), 'NewlyCreated': newlyCreated, 'PlayFabId': androidAccount.Account.UUID })
 
 def AddUsernamePassword(request):
 
@@ -250,7 +336,7 @@ def AddUsernamePassword(request):
 
 	# Request: {"Username": "theuser", "Email": "me@here.com", "Password": "thepassword"}
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 
@@ -269,7 +355,7 @@ def AddUsernamePassword(request):
 	if len(Password) < 6 or len(Password) > 30:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, 'Invalid input parameters', {"Password":["Password must be between 6 and 30 characters."]} )
 
-	return SuccessResponse({"Username": username })
+	return SuccessResponse(request, {"Username": username })
 
 
 def UpdateEmailAddress(request):
@@ -288,7 +374,7 @@ def UpdateEmailAddress(request):
 	
 	# Request: { "Email": "dev@null.com" }
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 	
@@ -310,7 +396,7 @@ def UpdateEmailAddress(request):
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'UnknownError', ErrorCodes.UnknownError, str(err) )
 	
 	if managedUserAccount.Email == Email:
-		return SuccessResponse({})
+		return SuccessResponse(request, {})
 	
 	if not ManagedUserAccount.isUniqueEmail():
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'EmailAddressNotAvailable', ErrorCodes.EmailAddressNotAvailable, 'Email address not available' )
@@ -323,7 +409,7 @@ def UpdateEmailAddress(request):
 		return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, 'Unknown Error' )
 	
 	# Return Success
-	return SuccessResponse({})
+	return SuccessResponse(request, {})
 
 def UpdatePassword(request):
 	if isNotJSONRequest(request):
@@ -337,7 +423,7 @@ def UpdatePassword(request):
 	
 	# Request: { "Email": "dev@null.com" }
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 	
@@ -367,7 +453,7 @@ def UpdateUserTitleDisplayName(request):
 	
 	# Request: { "DisplayName": "User Title Name" }
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 	
@@ -383,7 +469,7 @@ def UpdateUserTitleDisplayName(request):
 		return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, 'Unknown Error' )
 	
 	# {"DisplayName":"username"}
-	return SuccessResponse({"DisplayName":DisplayName})
+	return SuccessResponse(request, {"DisplayName":DisplayName})
 
 def LoginWithFacebook(request):
 	# { "TitleId": "1", "AccessToken": "FaceAccessTokenID", "CreateAccount": false }
@@ -407,7 +493,7 @@ def LoginWithIOSDeviceID(request):
 	
 	# Request: { "TitleId": "1", "DeviceId": "29848d9bh8900a0b003", "OS": "7.11", "DeviceModel": "Iphone 5s", "CreateAccount": false }
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 
@@ -446,8 +532,10 @@ def LoginWithIOSDeviceID(request):
 	iosAccount.Account.loginRefresh()
 	iosAccount.Account.save()
 
+	metrics.inc('openplaykit_logins_total', origination='iOS')
+
 	# { "SessionTicket": "4D2----8D11F4249A80000-7C64AB0A9F1D8D1A.CD803BF233CE76CC", "NewlyCreated": false }
-	return SuccessResponse({'SessionTicket': iosAccount.Account.SessionTicket, 'NewlyCreated': newlyCreated, 'PlayFabId': iosAccount.Account.UUID })
+	return SuccessResponse(request, {'SessionTicket': iosAccount.Account.createSession(), 'NewlyCreated': newlyCreated, 'PlayFabId': iosAccount.Account.UUID })
 
 def LoginWithSteam(request):
 	# { "TitleId": "1", "SteamTicket": "steamTicketID", "CreateAccount": false }
@@ -461,7 +549,7 @@ def SendAccountRecoveryEmail(request):
 
 	# { "Email": "Me@here.com", "TitleId": "1000" }
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 	
@@ -494,7 +582,7 @@ def LinkAndroidDeviceID(request):
 
 	# Request: {"AndroidDeviceId": "526f79204261747479", "OS": "5.0", "AndroidDevice": "Nexus 6" }
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 
@@ -518,7 +606,7 @@ def LinkAndroidDeviceID(request):
 			AndroidDevice.objects.create(AndroidDeviceId=androidDeviceId, OS=os, DeviceName=deviceName, Account=userAccount)
 		except Exception as err:
 			return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, str(err) )
-		return SuccessResponse({})
+		return SuccessResponse(request, {})
 	except exceptions.MultipleObjectsReturned:
 		return ErrorHttpResponse(request, 400, 'Error', 'LinkedAccountAlreadyClaimed', ErrorCodes.LinkedAccountAlreadyClaimed, 'Linked account already claimed' )
 	except Exception as err:
@@ -537,7 +625,7 @@ def LinkFacebookAccount(request):
 	
 	# { "AccessToken": "FaceAccessTokenID", "ForceLink": false }
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 
@@ -555,7 +643,7 @@ def LinkFacebookAccount(request):
 	except Exception as err:
 		return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, str(err) )
 	
-	return SuccessResponse({})
+	return SuccessResponse(request, {})
 
 def LinkGameCenterAccount(request):
 	# { "GameCenterId": "2998h2998f0b000d0993" }
@@ -577,11 +665,74 @@ def UnlinkSteamAccount(request):
 def GetFriendLeaderboard(request):
 	pass
 
+# Leaderboard rows as returned to the client, with one query for the players' names
+def leaderboardEntries(rows):
+	accounts = dict( (account.pk, account) for account in UserAccount.objects.filter(pk__in=[ accountId for position, accountId, value in rows ]).only('UUID', 'DisplayName') )
+	return [ {'PlayFabId': accounts[accountId].UUID, 'DisplayName': accounts[accountId].DisplayName, 'StatValue': value, 'Position': position} for position, accountId, value in rows if accountId in accounts ]
+
+def getLeaderboardParams(jsonrequest):
+	statisticName = jsonrequest.get('StatisticName')
+	if type(statisticName) not in (str, unicode) or statisticName == '':
+		raise TypeError('Missing StatisticName')
+
+	maxResultsCount = jsonrequest.get('MaxResultsCount', 10)
+	if type(maxResultsCount) != int or maxResultsCount < 1 or maxResultsCount > getattr(settings, 'LEADERBOARD_MAX_RESULTS', 100):
+		raise TypeError('Invalid MaxResultsCount')
+
+	return statisticName, maxResultsCount
+
 def GetLeaderboard(request):
-	pass
+	if isNotJSONRequest(request):
+		return HttpResponseBadRequest()
+
+	# Check authorization
+	try:
+		getAuthenticatedUser(request)
+	except Exception as err:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'NotAuthenticated', ErrorCodes.NotAuthenticated, str(err) )
+
+	# Request: { "StatisticName": "Kills", "StartPosition": 0, "MaxResultsCount": 20 }
+	try:
+		jsonrequest = GetJsonRequest(request)
+		statisticName, maxResultsCount = getLeaderboardParams(jsonrequest)
+	except TypeError as err:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
+
+	startPosition = jsonrequest.get('StartPosition', 0)
+	if type(startPosition) != int or startPosition < 0:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, 'Invalid StartPosition' )
+
+	try:
+		leaderboard = leaderboardEntries(getLeaderboard(statisticName).page(startPosition, maxResultsCount))
+	except Exception as err:
+		return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, str(err) )
+
+	# { "Leaderboard": [ { "PlayFabId": "...", "DisplayName": "Bob", "StatValue": 9001, "Position": 0 } ] }
+	return SuccessResponse(request, {'Leaderboard': leaderboard})
 
 def GetLeaderboardAroundCurrentUser(request):
-	pass
+	if isNotJSONRequest(request):
+		return HttpResponseBadRequest()
+
+	# Check authorization
+	try:
+		userAccount = getAuthenticatedUser(request)
+	except Exception as err:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'NotAuthenticated', ErrorCodes.NotAuthenticated, str(err) )
+
+	# Request: { "StatisticName": "Kills", "MaxResultsCount": 20 }
+	try:
+		jsonrequest = GetJsonRequest(request)
+		statisticName, maxResultsCount = getLeaderboardParams(jsonrequest)
+	except TypeError as err:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
+
+	try:
+		leaderboard = leaderboardEntries(getLeaderboard(statisticName).around(userAccount.pk, maxResultsCount))
+	except Exception as err:
+		return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, str(err) )
+
+	return SuccessResponse(request, {'Leaderboard': leaderboard})
 
 def GetUserData(request):
 	
@@ -596,36 +747,43 @@ def GetUserData(request):
 	
 	# Request: { "Keys": ["preferences","progress"] }
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 
 	Keys = jsonrequest.get('Keys')
 	
-	if Keys and type(Keys) == type([]):
-		resultData = {}
-		for k in Keys:
-			try:
-				userData = UserData.objects.get(Account=userAccount, Key=k)
-				resultData[k] = {'Value': userData.Data, 'LastUpdate': userData.LastUpdated, 'Permission': 'Public' }
-			except exceptions.ObjectDoesNotExist:
-				pass
-			except Exception as err:
-				return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, str(err) )
-	else:
-		try:
-			userData = UserData.objects.filter(Account=userAccount)
-			resultData = { item.Key: {'Value': item.Data, 'LastUpdate': item.LastUpdated, 'Permission': 'Public' } for item in userData }
-		except Exception as err:
-			return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, str(err) )
+	try:
+		userData = UserData.objects.filter(Account=userAccount).only('Key', 'Data', 'Encoding', 'Version', 'LastUpdated')
+		if Keys and type(Keys) == type([]):
+			userData = userData.filter(Key__in=Keys)
+		# Only the returned row of each key is decompressed
+		resultData = { key: {'Value': item.getValue(), 'LastUpdate': item.LastUpdated, 'Version': item.Version, 'Permission': 'Public' } for key, item in UserData.latestByKey(userData).items() }
+	except Exception as err:
+		return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, str(err) )
 
-	return SuccessResponse({'Data': resultData})
+	return SuccessResponse(request, {'Data': resultData})
 
 def GetUserReadOnlyData(request):
 	pass
 
 def GetUserStatistics(request):
-	pass
+	if isNotJSONRequest(request):
+		return HttpResponseBadRequest()
+
+	# Check authorization
+	try:
+		userAccount = getAuthenticatedUser(request)
+	except Exception as err:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'NotAuthenticated', ErrorCodes.NotAuthenticated, str(err) )
+
+	try:
+		statistics = dict( UserStatistic.objects.filter(Account=userAccount).values_list('Name', 'Value') )
+	except Exception as err:
+		return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, str(err) )
+
+	# { "UserStatistics": { "Kills": 10, "Score": 500 } }
+	return SuccessResponse(request, {'UserStatistics': statistics})
 
 def UpdateUserData(request):
 	if isNotJSONRequest(request):
@@ -638,55 +796,38 @@ def UpdateUserData(request):
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'NotAuthenticated', ErrorCodes.NotAuthenticated, str(err) )
 	
 	# Request: { "Data": { "Class": "Fighter", "Gender": "Female", "Icon": "Guard 3", "Theme": "Colorful" }, "Permission": "Public" }
+	# Patch request: { "Mode": "Patch", "Data": { "progress": { "Level": 4, "Boss": null } }, "Versions": { "progress": 7 } }
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 
 	data = jsonrequest.get('Data')
 	permission = jsonrequest.get('Permission')
+	mode = jsonrequest.get('Mode')
+	versions = jsonrequest.get('Versions') or {}
 
-	for key, value in data.items():
-		try:
-			try:
-				userData, created = UserData.objects.get_or_create(Key=key, Account=userAccount)
-			except exceptions.MultipleObjectsReturned:
-				# Clear multiple records
-				try:
-					UserData.objects.filter(Key=key, Account=userAccount.id).delete()
-					userData, created = UserData.objects.get_or_create(Key=key, Account=userAccount)
-				except Exception as err:
-					return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, 'Unknown Error' )
-				
-			userData.Data = value
-			try:
-				userData.save()
-			except Exception as err:
-				return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, 'Unknown Error' )
-
-		except Exception as err:
-			return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, str(err) )
-	
-	return SuccessResponse({})
+	if type(data) != dict:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, 'Missing Data' )
 
-def validateGoogleSignature(publicKey, signedData, signature):
-	from Crypto.Hash import SHA
-	from Crypto.PublicKey import RSA
-	from Crypto.Signature import PKCS1_v1_5
-	from base64 import b64decode
+	if type(versions) != dict or not all(type(version) == int for version in versions.values()):
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, 'Invalid Versions' )
 
-	def chunks(s, n):
-		for start in range(0, len(s), n):
-			yield s[start:start+n]
-		
-	def pem_format(key):
-		return '\n'.join([ '-----BEGIN PUBLIC KEY-----', '\n'.join(chunks(key, 64)), '-----END PUBLIC KEY-----' ])
+	try:
+		if mode == 'Patch':
+			return SuccessResponse(request, {'Versions': UserData.bulkPatch(userAccount, data, versions)})
+		UserData.bulkUpsert(userAccount, data)
+	except UserDataTooLarge as err:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'BodyTooLarge', ErrorCodes.BodyTooLarge, str(err) )
+	except UserDataConflict as err:
+		return ErrorHttpResponse(request, 409, 'Conflict', 'InvalidRequest', ErrorCodes.InvalidRequest, str(err) )
+	except Exception as err:
+		return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, str(err) )
 	
-	key = RSA.importKey(pem_format(publicKey))
-	verifier = PKCS1_v1_5.new(key)
-	data = SHA.new(signedData)
-	sig = b64decode(signature)
-	return verifier.verify(data, sig)
+	return SuccessResponse(request, {})
+
+def validateGoogleSignature(signedData, signature):
+	return receipts.verifySignature(receipts.PROVIDER_GOOGLEPLAY, signedData, signature)
 
 def ValidateGooglePlayPurchase(request):
 	
@@ -714,7 +855,7 @@ def ValidateGooglePlayPurchase(request):
 
 	# Parse request
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 
@@ -733,6 +874,8 @@ def ValidateGooglePlayPurchase(request):
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 	
 	transactionId = receipt.get('orderId')
+	if transactionId == None:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, 'Missing orderId' )
 
 	itemId = receipt.get('productId')
 	if itemId == None:
@@ -740,7 +883,7 @@ def ValidateGooglePlayPurchase(request):
 
 	# Find the product
 	try:
-		itemList = CatalogItem.objects.filter(ItemId = itemId)
+		itemList = CatalogItem.objects.filter(ItemId = itemId).select_related('Catalog')
 	except Exception as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'ItemNotFound', ErrorCodes.ItemNotFound, 'Item not found' )
 	
@@ -757,13 +900,7 @@ def ValidateGooglePlayPurchase(request):
 
 	# Validate signature
 	try:
-		import settings
-		publicKey = settings.GOOGLE_PUBLIC_KEY
-	except (ImportError, AttributeError) as err:
-		return ErrorHttpResponse(request, 400, 'BadRequest', 'UnknownError', ErrorCodes.UnknownError, 'Server misconfiguration. ' + str(err) )
-
-	try:
-		if validateGoogleSignature(publicKey, receiptJson, signature):
+		if validateGoogleSignature(receiptJson, signature):
 			pass
 		else:
 			# Record the bad transaction
@@ -771,38 +908,145 @@ def ValidateGooglePlayPurchase(request):
 				purchase = Purchase.objects.create(TransactionStatus=Purchase.STATUS_FAILEDBYPROVIDER, PaymentProvider=Purchase.PROVIDER_GOOGLEPLAY, Currency=itemPrice.Currency, Account=userAccount, Annotation=receiptJson)
 			except Exception as err:
 				return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, str(err) )
-			return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidReceipt', ErrorCodes.InvalidReceipt, 'Invalid Receipt' )
-	except ImportError as err:
+			return ReceiptRejectedResponse(request, receipts.PROVIDER_GOOGLEPLAY, 'InvalidReceipt', ErrorCodes.InvalidReceipt, 'Invalid Receipt' )
+	except (ImportError, exceptions.ImproperlyConfigured) as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'UnknownError', ErrorCodes.UnknownError, 'Server misconfiguration. ' + str(err) )
 	except Exception as err:
-		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidReceipt', ErrorCodes.InvalidReceipt, str(err) )
+		return ReceiptRejectedResponse(request, receipts.PROVIDER_GOOGLEPLAY, 'InvalidReceipt', ErrorCodes.InvalidReceipt, str(err) )
 	
-	# Check for receipt replay attack
-	try: 
-		purchases = Purchase.objects.filter(TransactionId=transactionId, PaymentProvider=Purchase.PROVIDER_GOOGLEPLAY).count()
+	# Claim the receipt, record the transaction and give the player their items / currency.
+	# The claim fails for a receipt that was already used (receipt replay attack).
+	try:
+		with transaction.atomic():
+			if not ReceiptClaim.claim(Purchase.PROVIDER_GOOGLEPLAY, transactionId, userAccount):
+				return ReceiptRejectedResponse(request, receipts.PROVIDER_GOOGLEPLAY, 'ReceiptAlreadyUsed', ErrorCodes.ReceiptAlreadyUsed, 'Receipt already used' )
+
+			purchase = Purchase.objects.create(TransactionId=transactionId, TransactionStatus=Purchase.STATUS_INIT, PaymentProvider=Purchase.PROVIDER_GOOGLEPLAY, Currency=itemPrice.Currency, Account=userAccount, Annotation=receiptJson)
+			item.assignToUser(userAccount, purchase)
+
+			purchase.TransactionStatus = Purchase.STATUS_SUCCEEDED
+			purchase.save()
+
 	except Exception as err:
-		return ErrorHttpResponse(request, 400, 'BadRequest', 'UnknownError', ErrorCodes.UnknownError, str(err) )
-	
-	if purchases > 0:
-		return ErrorHttpResponse(request, 400, 'BadRequest', 'ReceiptAlreadyUsed', ErrorCodes.ReceiptAlreadyUsed, 'Receipt already used' )
+		return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, str(err) )
+
+	return SuccessResponse(request, {})
+
+def ValidateGooglePlayPurchaseBatch(request):
+
+	if isNotJSONRequest(request):
+		return HttpResponseBadRequest()
+
+	# Check authorization
+	try:
+		userAccount = getAuthenticatedUser(request)
+	except Exception as err:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'NotAuthenticated', ErrorCodes.NotAuthenticated, str(err) )
+
+	# Request: { "Receipts": [ { "ReceiptJson": "{\"orderId\": ... }", "Signature": "ks12w0hH..." }, ... ] }
+	try:
+		jsonrequest = GetJsonRequest(request)
+	except TypeError as err:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
+
+	receiptList = jsonrequest.get('Receipts')
+	if receiptList == None or type(receiptList) != list:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, 'Missing Receipts' )
+
+	if len(receiptList) > 100:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'BodyTooLarge', ErrorCodes.BodyTooLarge, 'Too many receipts' )
+
+	def failed(result, error, errorCode):
+		result.update({'Status': error, 'errorCode': errorCode})
+		if errorCode in (ErrorCodes.InvalidReceipt, ErrorCodes.ReceiptAlreadyUsed):
+			metrics.inc('openplaykit_receipt_rejections_total', provider=receipts.PROVIDER_GOOGLEPLAY, reason=error)
 
-	# Record the transaction
+	# Parse receipts
+	results = []
+	pending = []
+	for entry in receiptList:
+		result = {'Status': 'OK'}
+		results.append(result)
+
+		if type(entry) != dict or entry.get('ReceiptJson') == None or entry.get('Signature') == None:
+			failed(result, 'InvalidParams', ErrorCodes.InvalidParams)
+			continue
+
+		try:
+			receipt = json.loads(entry['ReceiptJson'])
+		except (TypeError, ValueError):
+			failed(result, 'InvalidParams', ErrorCodes.InvalidParams)
+			continue
+
+		if type(receipt) != dict or receipt.get('productId') == None or receipt.get('orderId') == None:
+			failed(result, 'InvalidParams', ErrorCodes.InvalidParams)
+			continue
+
+		result['TransactionId'] = receipt.get('orderId')
+		result['ItemId'] = receipt['productId']
+		pending.append((result, entry))
+
+	# Validate signatures in parallel
 	try:
-		purchase = Purchase.objects.create(TransactionId=transactionId, TransactionStatus=Purchase.STATUS_INIT, PaymentProvider=Purchase.PROVIDER_GOOGLEPLAY, Currency=itemPrice.Currency, Account=userAccount, Annotation=receiptJson)
+		valid = receipts.verifySignatures(receipts.PROVIDER_GOOGLEPLAY, [ (entry['ReceiptJson'], entry['Signature']) for result, entry in pending ])
+	except (ImportError, exceptions.ImproperlyConfigured) as err:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'UnknownError', ErrorCodes.UnknownError, 'Server misconfiguration. ' + str(err) )
+
+	# Find the products, most recent catalog wins
+	try:
+		items = {}
+		itemList = CatalogItem.objects.filter(ItemId__in=set( result['ItemId'] for result, entry in pending )).select_related('Catalog')
+		for item in sorted(itemList, key=lambda x : x.Catalog.Created):
+			items[item.ItemId] = item
+
+		# Real Money (RM) prices
+		itemPrices = dict( (price.Item_id, price) for price in ItemPrice.objects.filter(Item__in=[ item.pk for item in items.values() ], Currency='RM').select_related('Currency') )
+
+		# Check for receipt replay attack
+		usedTransactions = set( Purchase.objects.filter(TransactionId__in=[ result['TransactionId'] for result, entry in pending ], PaymentProvider=Purchase.PROVIDER_GOOGLEPLAY).values_list('TransactionId', flat=True) )
 	except Exception as err:
 		return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, str(err) )
-	
-	# Give the player their items / currency
+
+	# Record the transactions and give the player their items / currency
 	try:
-		item.assignToUser(userAccount, purchase)
-	
-		purchase.TransactionStatus = Purchase.STATUS_SUCCEEDED
-		purchase.save()
+		with transaction.atomic():
+			for (result, entry), isValid in zip(pending, valid):
+				item = items.get(result['ItemId'])
+				if item == None:
+					failed(result, 'ItemNotFound', ErrorCodes.ItemNotFound)
+					continue
+
+				itemPrice = itemPrices.get(item.pk)
+				if itemPrice == None:
+					failed(result, 'PurchaseDoesNotExist', ErrorCodes.PurchaseDoesNotExist)
+					continue
+
+				if not isValid:
+					# Record the bad transaction
+					Purchase.objects.create(TransactionStatus=Purchase.STATUS_FAILEDBYPROVIDER, PaymentProvider=Purchase.PROVIDER_GOOGLEPLAY, Currency=itemPrice.Currency, Account=userAccount, Annotation=entry['ReceiptJson'])
+					failed(result, 'InvalidReceipt', ErrorCodes.InvalidReceipt)
+					continue
 
+				if result['TransactionId'] in usedTransactions:
+					failed(result, 'ReceiptAlreadyUsed', ErrorCodes.ReceiptAlreadyUsed)
+					continue
+				usedTransactions.add(result['TransactionId'])
+
+				try:
+					with transaction.atomic():
+						# Claiming still guards against a concurrent request with the same receipt
+						if not ReceiptClaim.claim(Purchase.PROVIDER_GOOGLEPLAY, result['TransactionId'], userAccount):
+							failed(result, 'ReceiptAlreadyUsed', ErrorCodes.ReceiptAlreadyUsed)
+							continue
+						purchase = Purchase.objects.create(TransactionId=result['TransactionId'], TransactionStatus=Purchase.STATUS_SUCCEEDED, PaymentProvider=Purchase.PROVIDER_GOOGLEPLAY, Currency=itemPrice.Currency, Account=userAccount, Annotation=entry['ReceiptJson'])
+						item.assignToUser(userAccount, purchase)
+				except Exception as err:
+					failed(result, 'UnknownError', ErrorCodes.UnknownError)
 	except Exception as err:
 		return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, str(err) )
 
-	return SuccessResponse({})
+	# Response: { "Results": [ { "Status": "OK", "TransactionId": "...", "ItemId": "..." }, { "Status": "ReceiptAlreadyUsed", "errorCode": 1022, ... } ] }
+	return SuccessResponse(request, {'Results': results})
 
 def parseAppleDataFormat( data ):
 	# Remove last semi-colon
@@ -815,17 +1059,7 @@ def parseAppleDataFormat( data ):
 	return json.loads(data)
 
 def validateIOSSignature(signedData, signature):
-	from Crypto.Hash import SHA
-	from Crypto.PublicKey import RSA
-	from Crypto.Signature import PKCS1_v1_5
-	from base64 import b64decode
-
-	appleCA = ''
-	key = RSA.importKey(appleCA)
-	verifier = PKCS1_v1_5.new(key)
-	data = SHA.new(signedData)
-	sig = b64decode(signature)
-	return verifier.verify(data, sig)
+	return receipts.verifySignature(receipts.PROVIDER_APPLE, signedData, signature)
 
 def ValidateIOSReceipt(request):
 	from base64 import b64decode
@@ -843,7 +1077,7 @@ def ValidateIOSReceipt(request):
 
 	# Parse request
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 
@@ -884,7 +1118,7 @@ def ValidateIOSReceipt(request):
 
 	# Find the product
 	try:
-		itemList = CatalogItem.objects.filter(ItemId = itemId)
+		itemList = CatalogItem.objects.filter(ItemId = itemId).select_related('Catalog')
 	except Exception as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'ItemNotFound', ErrorCodes.ItemNotFound, 'Item not found' )
 	
@@ -908,42 +1142,70 @@ def ValidateIOSReceipt(request):
 	if signature == None:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, 'Invalid ReceiptData' )
 	
-	if not validateIOSSignature(receiptDataRaw, signature):
-		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidReceipt', ErrorCodes.InvalidReceipt, 'Invalid Receipt' )
+	# Malformed signatures are invalid receipts, a missing certificate is our problem
+	try:
+		validSignature = validateIOSSignature(receiptDataRaw, signature)
+	except (ImportError, exceptions.ImproperlyConfigured) as err:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'UnknownError', ErrorCodes.UnknownError, 'Server misconfiguration. ' + str(err) )
+	except (ValueError, TypeError):
+		validSignature = False
 
-	# Check for receipt replay attack
-	try: 
-		purchases = Purchase.objects.filter(TransactionId=transactionId, PaymentProvider=Purchase.PROVIDER_APPLE).count()
-	except Exception as err:
-		return ErrorHttpResponse(request, 400, 'BadRequest', 'UnknownError', ErrorCodes.UnknownError, str(err) )
-	
-	if purchases > 0:
-		return ErrorHttpResponse(request, 400, 'BadRequest', 'ReceiptAlreadyUsed', ErrorCodes.ReceiptAlreadyUsed, 'Receipt already used' )
+	if not validSignature:
+		return ReceiptRejectedResponse(request, receipts.PROVIDER_APPLE, 'InvalidReceipt', ErrorCodes.InvalidReceipt, 'Invalid Receipt' )
 
-	# Record the transaction
-	try:
-		purchase = Purchase.objects.create(TransactionId=transactionId, TransactionStatus=Purchase.STATUS_INIT, PaymentProvider=Purchase.PROVIDER_APPLE, Currency=itemPrice.Currency, Account=userAccount, Annotation=purchaseInfoRaw)
-	except Exception as err:
-		return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, str(err) )
-	
-	# Give the player their items / currency
+	# Claim the receipt, record the transaction and give the player their items / currency.
+	# The claim fails for a receipt that was already used (receipt replay attack).
 	try:
-		item.assignToUser(userAccount, purchase)
-	
-		purchase.TransactionStatus = Purchase.STATUS_SUCCEEDED
-		purchase.save()
+		with transaction.atomic():
+			if not ReceiptClaim.claim(Purchase.PROVIDER_APPLE, transactionId, userAccount):
+				return ReceiptRejectedResponse(request, receipts.PROVIDER_APPLE, 'ReceiptAlreadyUsed', ErrorCodes.ReceiptAlreadyUsed, 'Receipt already used' )
+
+			purchase = Purchase.objects.create(TransactionId=transactionId, TransactionStatus=Purchase.STATUS_INIT, PaymentProvider=Purchase.PROVIDER_APPLE, Currency=itemPrice.Currency, Account=userAccount, Annotation=purchaseInfoRaw)
+			item.assignToUser(userAccount, purchase)
+
+			purchase.TransactionStatus = Purchase.STATUS_SUCCEEDED
+			purchase.save()
 
 	except Exception as err:
 		return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, str(err) )
 
-	return SuccessResponse({})
+	return SuccessResponse(request, {})
 	
 
 def RegisterForIOSPushNotification(request):
 	pass
 
 def UpdateUserStatistics(request):
-	pass
+	if isNotJSONRequest(request):
+		return HttpResponseBadRequest()
+
+	# Check authorization
+	try:
+		userAccount = getAuthenticatedUser(request)
+	except Exception as err:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'NotAuthenticated', ErrorCodes.NotAuthenticated, str(err) )
+
+	# Request: { "UserStatistics": { "Kills": 10, "Score": 500 } }
+	try:
+		jsonrequest = GetJsonRequest(request)
+	except TypeError as err:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
+
+	statistics = jsonrequest.get('UserStatistics')
+	if type(statistics) != dict or len(statistics) == 0:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, 'Missing UserStatistics' )
+
+	for name, value in statistics.items():
+		if len(name) == 0 or len(name) > 64 or type(value) != int or abs(value) >= 2 ** 31:
+			return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidUserStatistics', ErrorCodes.InvalidUserStatistics, 'Invalid statistic ' + name )
+
+	try:
+		changed = UserStatistic.bulkUpdate(userAccount, statistics)
+	except Exception as err:
+		return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, str(err) )
+
+	statisticsChanged(userAccount.pk, changed)
+	return SuccessResponse(request, {})
 
 def GetCatalogItems(request):
 
@@ -958,7 +1220,7 @@ def GetCatalogItems(request):
 
 	# Parse request
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 
@@ -973,13 +1235,25 @@ def GetCatalogItems(request):
 	except Exception as err:
 		return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, str(err) )
 
+	# A client holding the current version is answered without loading the snapshot.
+	# Snapshots never claim a newer version than their content, so this is safe.
+	try:
+		etag = makeETag(codec.responseContentType(request), 'Catalog', catalog.pk, catalog.getVersion())
+	except Exception as err:
+		return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, str(err) )
+
+	if isNotModified(request, etag):
+		return NotModifiedResponse(etag)
+
 	try:
-		catalogItems = [ item.getCatalogRepresentation() for item in CatalogItem.objects.filter(Catalog=catalog) ]
+		snapshot = catalog.getSnapshot()
 	except Exception as err:
 		return ErrorHttpResponse(request, 400, 'Error', 'UnknownError', ErrorCodes.UnknownError, str(err) )
 
+	# Tag the content actually served, the live version may already be ahead of it
+	etag = makeETag(codec.responseContentType(request), 'Catalog', catalog.pk, snapshot.Version)
 
-	return SuccessResponse({'Catalog': catalogItems })
+	return RawSuccessResponse(request, '{"Catalog": ' + snapshot.Data + '}', etag)
 
 def GetStoreItems(request):
 	pass
@@ -996,11 +1270,15 @@ def GetTitleData(request):
 	
 	# Request: { "Keys": [ "color", "propertyA" ] }
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 
 	keys = jsonrequest.get('Keys')
+
+	etag = makeETag(codec.responseContentType(request), 'TitleData', ContentVersion.getVersion('TitleData'), json.dumps(keys))
+	if isNotModified(request, etag):
+		return NotModifiedResponse(etag)
 	
 	if keys and type(keys) == type([]):
 		try:
@@ -1010,7 +1288,7 @@ def GetTitleData(request):
 	else :
 		elements = TitleData.objects.all()
 
-	return SuccessResponse( {'Data': { e.Key: e.Data for e in elements } } )
+	return SuccessResponse(request, {'Data': { e.Key: e.Data for e in elements } }, etag )
 
 def GetTitleNews(request):
 	if isNotJSONRequest(request):
@@ -1024,19 +1302,23 @@ def GetTitleNews(request):
 	
 	# Request: { "Count": 25 }
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 
 	count = jsonrequest.get('Count', 10)
 
+	etag = makeETag(codec.responseContentType(request), 'NewsItem', ContentVersion.getVersion('NewsItem'), count)
+	if isNotModified(request, etag):
+		return NotModifiedResponse(etag)
+
 	news = []
 	for item in NewsItem.objects.all():
 		news.append( { 'Timestamp': item.Timestamp, 'Title': item.Title, 'Body': item.Body } )
 
 	news = news[0:count]
 
-	return SuccessResponse( {'News': news } )
+	return SuccessResponse(request, {'News': news }, etag )
 
 def ConsumeItem(request):
 	if isNotJSONRequest(request):
@@ -1050,7 +1332,7 @@ def ConsumeItem(request):
 	
 	# Request: { "ItemInstanceId": "94585729", "ConsumeCount": 1 }
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 
@@ -1061,46 +1343,33 @@ def ConsumeItem(request):
 	if consumeCount == None:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, 'Missing ConsumeCount' )
 
+	if type(consumeCount) != int or consumeCount < 1:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.NonPositiveValue, 'Invalid ConsumeCount' )
+
 	# Look up item by id
 	if itemId != None:
-		try:
-			userItems = UserItems.objects.get(Account=userAccount)
-		except exceptions.ObjectDoesNotExist:
-			return ErrorHttpResponse(request, 400, 'BadRequest', 'ItemNotFound', ErrorCodes.ItemNotFound, 'Item not found' )
-
-		for item in userItems:
-			if item.Item.ItemId == itemId:
-				userItem = item
-				break	
-
+		userItem = UserItems.objects.filter(Account=userAccount, Item__ItemId=itemId).exclude(RemainingUses=0).select_related('Item').first()
 		if userItem == None:
 			return ErrorHttpResponse(request, 400, 'BadRequest', 'ItemNotFound', ErrorCodes.ItemNotFound, 'Item not found' )
 
 	# Find item by InstanceId
-	elif itemId != None:
+	elif itemInstanceId != None:
 		try:
-			userItem = UserItems.objects.get(ItemId=itemId, Account=userAccount)
-		except exceptions.ObjectDoesNotExist:
+			userItem = UserItems.objects.select_related('Item').get(pk=itemInstanceId, Account=userAccount)
+		except (exceptions.ObjectDoesNotExist, ValueError):
 			return ErrorHttpResponse(request, 400, 'BadRequest', 'ItemNotFound', ErrorCodes.ItemNotFound, 'Item not found' )
 	else:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, 'Missing ItemInstanceId' )
 
-	if userItem.RemainingUses >= consumeCount:
-		# Consume
-		userItem.consume(consumeCount)
-		
-		userItem.RemainingUses = userItem.RemainingUses - consumeCount
-
-		if ( userItem.RemainingUses <= 0)
-			userItem.RemainingUses = 0
-			userItem.delete()
-		else:
-			userItem.save()
-		
-	else:
+	# Consume
+	remainingUses = userItem.consume(consumeCount)
+	if remainingUses == None:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'NoRemainingUses', ErrorCodes.NoRemainingUses, 'No remaining uses' )
 
-	return SuccessResponse( {'ItemInstanceId': userItem.itemInstanceId, 'RemainingUses':  userItem.RemainingUses } )
+	if remainingUses <= 0:
+		UserItems.objects.filter(pk=userItem.pk, RemainingUses=0).delete()
+
+	return SuccessResponse(request, {'ItemInstanceId': str(userItem.pk), 'RemainingUses': remainingUses } )
 
 def RedeemCoupon(request):
 	pass
@@ -1117,7 +1386,7 @@ def AddUserVirtualCurrency(request, subtract=False):
 	
 	# Request: { "VirtualCurrency": "GC", "Amount": 100 }
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 	
@@ -1148,22 +1417,17 @@ def AddUserVirtualCurrency(request, subtract=False):
 	if userCurrency.Currency.RemotelyMutable != True:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.APINotEnabledForGameClientAccess, 'Currency cannot be changed' )
 
-	if subtract == True:
-		balanceChange = -amount
-	else:
-		balanceChange = amount
-
-	userCurrency.Amount = userCurrency.Amount + balanceChange
-	
-	if userCurrency.Amount < 0:
-		userCurrency.Amount = 0
-
+	# Subtracting never takes the balance below zero
 	try:
-		userCurrency.save()
+		if subtract == True:
+			balanceChange = -userCurrency.debitUpTo(amount, CurrencyLedger.REASON_CLIENT)
+		else:
+			userCurrency.credit(amount, CurrencyLedger.REASON_CLIENT)
+			balanceChange = amount
 	except Exception as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'UnknownError', ErrorCodes.UnknownError, str(err) )
 
-	return SuccessResponse( {'PlayFabId': userAccount.UUID, 'VirtualCurrency': virtualCurrency, 'BalanceChange': balanceChange, 'Balance': userCurrency.Amount } )
+	return SuccessResponse(request, {'PlayFabId': userAccount.UUID, 'VirtualCurrency': virtualCurrency, 'BalanceChange': balanceChange, 'Balance': userCurrency.getBalance() } )
 
 def SubtractUserVirtualCurrency(request):
 	return AddUserVirtualCurrency(request, True)
@@ -1183,7 +1447,7 @@ def StartPurchase(request):
 	
 	# Request: { "CatalogVersion": "0", "StoreId": "BonusStore", "Items": [ { "ItemId": "something", "Quantity": 1, "Annotation": "totally buying something" } ] }
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 
@@ -1202,7 +1466,7 @@ def PayForPurchase(request):
 	
 	# Request: { "OrderId": "8853591446005860822", "ProviderName": "PayPal", "Currency": "RM" }
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 
@@ -1222,7 +1486,7 @@ def ConfirmPurchase(request):
 	
 	# Request: { "OrderId": "8853591446005860822" }
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 
@@ -1243,7 +1507,7 @@ def PurchaseItem(request):
 
 	# Request: { "ItemId": "shield_level_5", "VirtualCurrency": "GV", "Price": 25, CatalogVersion: 1 }
 	try:
-		jsonrequest = GetJsonRequest(request.body)
+		jsonrequest = GetJsonRequest(request)
 	except TypeError as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
 
@@ -1263,7 +1527,7 @@ def PurchaseItem(request):
 
 	if catalogVersion == None:
 		try:
-			itemList = CatalogItem.objects.filter(ItemId = itemId)
+			itemList = CatalogItem.objects.filter(ItemId = itemId).select_related('Catalog')
 		except Exception as err:
 			return ErrorHttpResponse(request, 400, 'BadRequest', 'UnknownError', ErrorCodes.UnknownError, str(err) )
 		
@@ -1304,22 +1568,24 @@ def PurchaseItem(request):
 	except Exception as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'UnknownError', ErrorCodes.UnknownError, str(err) )
 
-	if userCurrency.canBuy(itemPrice.Price):
-		
-		# Record the purchase
-		purchase = Purchase.objects.create(TransactionId=getUUID(), TransactionStatus=Purchase.STATUS_SUCCEEDED, PaymentProvider=Purchase.PROVIDER_VIRTUALCURRENCY, Currency=itemPrice.Currency, Account=userAccount)
-		
-		# Debit the cost of the item
-		userCurrency.debit(itemPrice.Price)
+	# Debit, record and grant in one transaction so a failed grant leaves the balance untouched
+	orderId = getUUID()
+	try:
+		with transaction.atomic():
+			# Debit the cost of the item, fails when the balance does not cover it
+			if not userCurrency.debit(itemPrice.Price, CurrencyLedger.REASON_PURCHASE, orderId):
+				return ErrorHttpResponse(request, 400, 'BadRequest', 'InsufficientFunds', ErrorCodes.InsufficientFunds, 'Insufficient Funds' )
 
-		# Give the player their items / currency
-		newItems = item.assignToUser(userAccount, purchase)
+			# Record the purchase
+			purchase = Purchase.objects.create(OrderId=orderId, TransactionId=getUUID(), TransactionStatus=Purchase.STATUS_SUCCEEDED, PaymentProvider=Purchase.PROVIDER_VIRTUALCURRENCY, Currency=itemPrice.Currency, Account=userAccount)
 
-		# Response: { "code": 200, "status": "OK", "data": { "Items": [ { "ItemId": "shield_level_5", "CatalogVersion": "5", "DisplayName": "Level 5 Shield", "UnitCurrency": "GV", "UnitPrice": 25 } ] } }
-		return SuccessResponse({'Items': newItems})
-		
-	else:
-		return ErrorHttpResponse(request, 400, 'BadRequest', 'InsufficientFunds', ErrorCodes.InsufficientFunds, 'Insufficient Funds' )
+			# Give the player their items / currency
+			newItems = item.assignToUser(userAccount, purchase)
+	except Exception as err:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'UnknownError', ErrorCodes.UnknownError, str(err) )
+
+	# Response: { "code": 200, "status": "OK", "data": { "Items": [ { "ItemId": "shield_level_5", "CatalogVersion": "5", "DisplayName": "Level 5 Shield", "UnitCurrency": "GV", "UnitPrice": 25 } ] } }
+	return SuccessResponse(request, {'Items': newItems})
 
 def GetUserInventory(request):
 
@@ -1347,26 +1613,21 @@ def GetUserInventory(request):
 	data['Inventory'] = itemResults
 
 	# Get virtual currency
-	virtualCurrency = {}
-
 	try:
 		allCurrency = CurrencyType.objects.all().exclude(CurrencyCode='RM')
 	except Exception as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'UnknownError', ErrorCodes.UnknownError, str(err) )
 
-	for currency in allCurrency:
-		try:
-			userCurrency = userAccount.getCurrency(currency)
-		except Exception, err:
-			return ErrorHttpResponse(request, 400, 'BadRequest', 'UnknownError', ErrorCodes.UnknownError, str(err) )
-		
-		virtualCurrency[currency.CurrencyCode] = userCurrency.Amount
+	try:
+		virtualCurrency = userAccount.getCurrencyBalances(allCurrency)
+	except Exception, err:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'UnknownError', ErrorCodes.UnknownError, str(err) )
 		
 	data['VirtualCurrency'] = virtualCurrency
 	
 	#data['VirtualCurrencyRechargeTimes'] = {}
 	
-	return SuccessResponse(data)
+	return SuccessResponse(request, data)
 
 def AddFriend(request):
 	pass
@@ -1427,6 +1688,7 @@ def ResetUser(request):
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'NotAuthenticated', ErrorCodes.NotAuthenticated, str(err) )
 
 	try:
+		userAccount.revokeSessions()
 		userAccount.SessionTicket = 'deleted'
 		userAccount.Active = False
 		userAccount.save()
@@ -1450,4 +1712,134 @@ def ResetUser(request):
 	except Exception as err:
 		return ErrorHttpResponse(request, 400, 'BadRequest', 'UnknownError', ErrorCodes.UnknownError, str(err) )
 
-	return SuccessResponse({})
+	return SuccessResponse(request, {})
+
+# Calls that can be made through ExecuteBatch, the read-only ones may run concurrently
+batchViews = {
+	'GetTitleData': GetTitleData,
+	'GetTitleNews': GetTitleNews,
+	'GetCatalogItems': GetCatalogItems,
+	'GetUserInventory': GetUserInventory,
+	'GetUserData': GetUserData,
+	'UpdateUserData': UpdateUserData,
+	'UpdateUserTitleDisplayName': UpdateUserTitleDisplayName,
+	'ConsumeItem': ConsumeItem,
+	'PurchaseItem': PurchaseItem,
+	'AddUserVirtualCurrency': AddUserVirtualCurrency,
+	'SubtractUserVirtualCurrency': SubtractUserVirtualCurrency,
+}
+
+# Calls that may run side by side. GetUserInventory is not one of them, it creates
+# the player's missing currency rows.
+batchReadOnlyViews = set(['GetTitleData', 'GetTitleNews', 'GetCatalogItems', 'GetUserData'])
+
+# Headers that only make sense for the batch as a whole
+batchDroppedHeaders = ('CONTENT_LENGTH', 'HTTP_ACCEPT_ENCODING', 'HTTP_IF_NONE_MATCH', 'HTTP_X_HTTPERRORASSUCCESS')
+
+_batchPool = None
+_batchPoolLock = threading.Lock()
+
+def getBatchPool():
+	global _batchPool
+	size = getattr(settings, 'BATCH_WORKERS', 4)
+	if size <= 0:
+		return None
+
+	if _batchPool is None:
+		with _batchPoolLock:
+			if _batchPool is None:
+				from multiprocessing.pool import ThreadPool
+				_batchPool = ThreadPool(size)
+	return _batchPool
+
+def makeBatchRequest(request, userAccount, body):
+	subRequest = HttpRequest()
+	subRequest.method = 'POST'
+	subRequest.path = request.path
+	subRequest.META = dict((key, value) for key, value in request.META.items() if key not in batchDroppedHeaders)
+	subRequest.META['CONTENT_TYPE'] = codec.JSON
+	subRequest.META['HTTP_ACCEPT'] = codec.JSON
+	subRequest.decodedBody = body
+	subRequest.authenticatedUser = userAccount
+	return subRequest
+
+def runBatchRequest(args):
+	view, subRequest = args
+	try:
+		response = view(subRequest)
+	except Exception as err:
+		return {'code': 500, 'status': 'Error', 'errorCode': ErrorCodes.UnknownError, 'errorMessage': str(err), 'errorDetails': {} }
+
+	if not response.content:
+		return {'code': response.status_code, 'status': response.reason_phrase}
+	return json.loads(response.content)
+
+def runConcurrentBatchRequest(args):
+	try:
+		return runBatchRequest(args)
+	finally:
+		# Worker threads hold their own database connection
+		connection.close()
+
+def ExecuteBatch(request):
+	if isNotJSONRequest(request):
+		return HttpResponseBadRequest()
+
+	# Check authorization, shared by every call in the batch
+	try:
+		userAccount = getAuthenticatedUser(request)
+	except Exception as err:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'NotAuthenticated', ErrorCodes.NotAuthenticated, str(err) )
+
+	# Request: { "Requests": [ { "Name": "GetTitleData", "Body": { "Keys": [ "color" ] } }, { "Name": "GetUserInventory", "Body": {} } ] }
+	try:
+		jsonrequest = GetJsonRequest(request)
+	except TypeError as err:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, str(err) )
+
+	calls = jsonrequest.get('Requests')
+	if type(calls) != list or len(calls) == 0:
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, 'Missing Requests' )
+
+	if len(calls) > getattr(settings, 'BATCH_MAX_REQUESTS', 20):
+		return ErrorHttpResponse(request, 400, 'BadRequest', 'BodyTooLarge', ErrorCodes.BodyTooLarge, 'Too many requests' )
+
+	work = []
+	for call in calls:
+		name = call.get('Name') if type(call) == dict else None
+		if name not in batchViews:
+			return ErrorHttpResponse(request, 400, 'BadRequest', 'InvalidParams', ErrorCodes.InvalidParams, 'Unknown request ' + str(name) )
+		work.append((name, makeBatchRequest(request, userAccount, call.get('Body') or {})))
+
+	# Consecutive read-only calls run together, any other call waits for the ones
+	# before it and runs on its own so results match calling them in order
+	results = []
+	pool = getBatchPool()
+	start = 0
+	while start < len(work):
+		end = start
+		while end < len(work) and work[end][0] in batchReadOnlyViews:
+			end = end + 1
+
+		if pool != None and end - start > 1:
+			results.extend(pool.map(runConcurrentBatchRequest, [ (batchViews[name], subRequest) for name, subRequest in work[start:end] ]))
+		else:
+			end = max(end, start + 1)
+			results.extend([ runBatchRequest((batchViews[name], subRequest)) for name, subRequest in work[start:end] ])
+		start = end
+
+	return SuccessResponse(request, {'Results': results})
+
+# Folds sharded currency credits into the balances. Called by App Engine cron,
+# which sets X-Appengine-Cron and strips it from outside requests, or by staff.
+def CompactCurrencyShards(request):
+	if request.META.get('HTTP_X_APPENGINE_CRON') != 'true' and not (request.user.is_active and request.user.is_staff):
+		return HttpResponse(status=403)
+
+	moved = UserCurrencyShard.compactAll()
+	return HttpResponse('Compacted %d currency units' % moved, content_type='text/plain')
+
+# Counters of all workers in the Prometheus text format, for staff only
+@staff_member_required
+def Metrics(request):
+	return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4')